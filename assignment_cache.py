@@ -0,0 +1,137 @@
+import json
+import sqlite3
+from collections import defaultdict
+
+from process_hits import BoxRecord, harvest_assignments, parse_assignment_answers
+
+"""
+A local sqlite store of harvested assignments and their parsed answers, keyed by HITId/AssignmentId.
+Repeat harvests skip HITs whose assignments have all been approved or rejected, and only parse assignments
+that are new, so a notebook re-run only pays for work that changed since the last one.
+"""
+
+final_statuses = ('Approved', 'Rejected')
+
+
+def open_assignment_cache(cache_path):
+    """
+    Opens (and creates if needed) the assignment cache.
+    :param cache_path: sqlite database file
+    :return: sqlite connection
+    """
+    cache = sqlite3.connect(cache_path, check_same_thread=False)
+    cache.execute("""
+        CREATE TABLE IF NOT EXISTS assignments (
+            assignment_id TEXT PRIMARY KEY,
+            hit_id TEXT NOT NULL,
+            worker_id TEXT,
+            status TEXT,
+            answers TEXT NOT NULL
+        )""")
+    cache.execute('CREATE INDEX IF NOT EXISTS assignments_by_hit ON assignments (hit_id)')
+    cache.commit()
+    return cache
+
+
+def get_cached_statuses(cache):
+    """
+    :param cache: open assignment cache
+    :return: assignment_id:status dict for every cached assignment
+    """
+    return dict(cache.execute('SELECT assignment_id, status FROM assignments'))
+
+
+def get_settled_hits(cache):
+    """
+    Finds HITs whose cached assignments are all approved or rejected. Their statuses can no longer change, so
+    there is no need to fetch them again.
+    :param cache: open assignment cache
+    :return: set of HITIds
+    """
+    settled = cache.execute("""
+        SELECT hit_id FROM assignments
+        GROUP BY hit_id
+        HAVING SUM(CASE WHEN status IN (?, ?) THEN 0 ELSE 1 END) = 0""", final_statuses)
+    return {row[0] for row in settled}
+
+
+def update_assignment_cache(cache, assignments_by_hit):
+    """
+    Adds new assignments to the cache and records status changes of cached ones. Answers are only parsed for
+    assignments that are not cached yet.
+    :param cache: open assignment cache
+    :param assignments_by_hit: hit_id:assignment dict, as returned by get_assignments
+    :return: number of new assignments and number of assignments whose status changed
+    """
+    cached_statuses = get_cached_statuses(cache)
+    new_rows = []
+    status_changes = []
+    for hit_id, hit_assignments in assignments_by_hit.items():
+        for assignment in hit_assignments:
+            cached_status = cached_statuses.get(assignment.AssignmentId)
+            if cached_status is None:
+                answers = json.dumps(parse_assignment_answers(assignment))
+                new_rows.append((assignment.AssignmentId, hit_id, assignment.WorkerId, assignment.AssignmentStatus,
+                                 answers))
+            elif cached_status != assignment.AssignmentStatus:
+                status_changes.append((assignment.AssignmentStatus, assignment.AssignmentId))
+    with cache:
+        cache.executemany('INSERT INTO assignments VALUES (?, ?, ?, ?, ?)', new_rows)
+        cache.executemany('UPDATE assignments SET status = ? WHERE assignment_id = ?', status_changes)
+    return len(new_rows), len(status_changes)
+
+
+def harvest_new_assignments(mturk_connection, cache, status=None, workers=8, max_rps=None):
+    """
+    Harvests reviewable HITs into the cache, skipping HITs whose cached assignments are all settled.
+    :param mturk_connection: active mturk connection established by user in the nb.
+    :param cache: open assignment cache
+    :param status: HIT status to filter by.
+    :param workers: number of concurrent get_assignments requests
+    :param max_rps: maximum requests per second
+    :return: number of new assignments and number of assignments whose status changed
+    """
+    settled_hits = get_settled_hits(cache)
+    fresh_assignments = harvest_assignments(mturk_connection, status=status, workers=workers, max_rps=max_rps,
+                                            hit_filter=lambda hit_id: hit_id not in settled_hits)
+    return update_assignment_cache(cache, fresh_assignments)
+
+
+def load_cached_results(cache, hit_ids=None, status=None):
+    """
+    Reads cached answers back in the form process_raw_hits returns.
+    :param cache: open assignment cache
+    :param hit_ids: optional collection of HITIds to restrict to
+    :param status: optional assignment status to restrict to
+    :return: A nested dict with the box_id:assigned labels at the lowest level.
+    """
+    mechanical_turk_results = defaultdict(list)
+    query = 'SELECT hit_id, assignment_id, status, answers FROM assignments ORDER BY rowid'
+    for hit_id, assignment_id, assignment_status, answers in cache.execute(query):
+        if hit_ids is not None and hit_id not in hit_ids:
+            continue
+        if status and assignment_status != status:
+            continue
+        for page, box_json in json.loads(answers):
+            mechanical_turk_results[hit_id].append({assignment_id: {page: box_json}})
+    return mechanical_turk_results
+
+
+def iter_cached_box_records(cache, hit_ids=None, status=None):
+    """
+    Streams the cached answers as flat box records, for make_results_df_from_records.
+    :param cache: open assignment cache
+    :param hit_ids: optional collection of HITIds to restrict to
+    :param status: optional assignment status to restrict to
+    :return: generator of BoxRecords
+    """
+    query = 'SELECT hit_id, assignment_id, worker_id, status, answers FROM assignments ORDER BY rowid'
+    for hit_id, assignment_id, worker_id, assignment_status, answers in cache.execute(query):
+        if hit_ids is not None and hit_id not in hit_ids:
+            continue
+        if status and assignment_status != status:
+            continue
+        for page, box_json in json.loads(answers):
+            for box in box_json:
+                yield BoxRecord(hit_id, assignment_id, worker_id, page, box['id'], box['category'],
+                                box.get('group_n', 0))
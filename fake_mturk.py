@@ -0,0 +1,125 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import boto.mturk.connection as tc
+
+"""
+A local, in-memory stand-in for the boto mturk connection methods used in process_hits.
+It lets the concurrent HIT creation, harvest and review code be exercised and timed without touching mturk.
+"""
+
+
+class FakeRecord(object):
+    """
+    Attribute bag standing in for the boto HIT, Assignment and QuestionFormAnswer result objects.
+    """
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+def make_fake_answers(page, boxes):
+    """
+    Formats one page of box labels the way the annotation HIT returns them.
+    :param page: page image name
+    :param boxes: list of {'id', 'category'} box dicts
+    :return: a boto-style answer set for an assignment
+    """
+    return [FakeRecord(qid='page', fields=[page]), FakeRecord(qid='results', fields=[json.dumps(boxes)])]
+
+
+class FakeMTurkConnection(object):
+    """
+    Implements the subset of boto.mturk.connection.MTurkConnection that process_hits calls.
+    :param latency: seconds every call sleeps, to mimic a network round trip
+    :param throttle_every: when set, every n-th call fails with a throttling error before doing anything
+    """
+    def __init__(self, latency=0.0, throttle_every=None):
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.hits = OrderedDict()
+        self.assignments = OrderedDict()
+        self.blocked_workers = {}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def _request(self, method_name):
+        with self.lock:
+            self.calls.append(method_name)
+            n_calls = len(self.calls)
+        if self.latency:
+            time.sleep(self.latency)
+        if self.throttle_every and n_calls % self.throttle_every == 0:
+            raise tc.MTurkRequestError(503, 'Service Unavailable', '<Code>AWS.ServiceUnavailable</Code>')
+
+    def call_count(self, method_name):
+        return self.calls.count(method_name)
+
+    def create_hit(self, question=None, max_assignments=1, **hit_params):
+        self._request('create_hit')
+        with self.lock:
+            hit_id = 'HIT' + str(len(self.hits))
+            hit = FakeRecord(HITId=hit_id, HITStatus='Assignable', question=question,
+                             MaxAssignments=max_assignments, **hit_params)
+            self.hits[hit_id] = hit
+            self.assignments[hit_id] = []
+        return [hit]
+
+    def add_assignment(self, hit_id, worker_id, answers, status='Submitted'):
+        """
+        Simulates a worker submitting an assignment for a HIT.
+        :param answers: list of answer sets built with make_fake_answers
+        :return: the new assignment
+        """
+        with self.lock:
+            assignment = FakeRecord(AssignmentId=hit_id + '_A' + str(len(self.assignments[hit_id])), HITId=hit_id,
+                                    WorkerId=worker_id, AssignmentStatus=status, answers=answers)
+            self.assignments[hit_id].append(assignment)
+            self.hits[hit_id].HITStatus = 'Reviewable'
+        return assignment
+
+    def _find_assignment(self, assignment_id):
+        for hit_assignments in self.assignments.values():
+            for assignment in hit_assignments:
+                if assignment.AssignmentId == assignment_id:
+                    return assignment
+        raise tc.MTurkRequestError(400, 'Bad Request', '<Code>AWS.MechanicalTurk.AssignmentDoesNotExist</Code>')
+
+    def get_all_hits(self):
+        self._request('get_all_hits')
+        return iter(list(self.hits.values()))
+
+    def get_reviewable_hits(self, page_size=10, page_number=1, **kwargs):
+        self._request('get_reviewable_hits')
+        reviewable = [hit for hit in self.hits.values() if hit.HITStatus == 'Reviewable']
+        start = (page_number - 1) * page_size
+        return reviewable[start:start + page_size]
+
+    def get_assignments(self, hit_id, status=None, page_size=10, **kwargs):
+        self._request('get_assignments')
+        hit_assignments = [a for a in self.assignments.get(hit_id, []) if not status or a.AssignmentStatus == status]
+        return hit_assignments[:page_size]
+
+    def approve_assignment(self, assignment_id, feedback=None):
+        self._request('approve_assignment')
+        assignment = self._find_assignment(assignment_id)
+        if assignment.AssignmentStatus != 'Submitted':
+            raise tc.MTurkRequestError(400, 'Bad Request', '<Code>AWS.MechanicalTurk.InvalidAssignmentState</Code>')
+        assignment.AssignmentStatus = 'Approved'
+
+    def reject_assignment(self, assignment_id, feedback=None):
+        self._request('reject_assignment')
+        assignment = self._find_assignment(assignment_id)
+        if assignment.AssignmentStatus != 'Submitted':
+            raise tc.MTurkRequestError(400, 'Bad Request', '<Code>AWS.MechanicalTurk.InvalidAssignmentState</Code>')
+        assignment.AssignmentStatus = 'Rejected'
+
+    def block_worker(self, worker_id, reason):
+        self._request('block_worker')
+        self.blocked_workers[worker_id] = reason
+
+    def disable_hit(self, hit_id, response_groups=None):
+        self._request('disable_hit')
+        self.hits.pop(hit_id)
+        self.assignments.pop(hit_id)
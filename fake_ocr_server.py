@@ -0,0 +1,124 @@
+import argparse
+import json
+import threading
+import time
+import random
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+"""
+A small local stand-in for the vision ocr service, so the ocr client's throughput path can be tested and
+benchmarked without network access. It accepts the same json POST as the real service and answers with
+made-up detections after a configurable delay.
+"""
+
+
+def make_fake_detections(image_url, n_boxes=12):
+    rng = random.Random(image_url)
+    detections = []
+    for box_n in range(n_boxes):
+        x, y = rng.randint(0, 600), rng.randint(0, 900)
+        detections.append({
+            'value': 'word' + str(box_n),
+            'score': round(rng.random(), 3),
+            'rectangle': [{'x': x, 'y': y}, {'x': x + rng.randint(10, 200), 'y': y + rng.randint(10, 40)}]
+        })
+    return {'detections': detections}
+
+
+class FakeOcrHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # buffer each response into a single write so keep-alive clients aren't stalled by delayed acks
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        request_data = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            request_n = server.request_count
+        time.sleep(server.latency)
+        if server.fail_every and request_n % server.fail_every == 0:
+            self.send_json(503, {'error': 'service unavailable'})
+        else:
+            self.send_json(200, make_fake_detections(request_data['url']))
+
+    def send_json(self, status, response_data):
+        body = json.dumps(response_data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeOcrServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.05, fail_every=None):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeOcrHandler)
+        self.latency = latency
+        self.fail_every = fail_every
+        self.request_count = 0
+        self.lock = threading.Lock()
+
+    @property
+    def api_entry_point(self):
+        return 'http://127.0.0.1:' + str(self.server_address[1]) + '/v1/ocr'
+
+
+def start_fake_ocr_server(port=0, latency=0.05, fail_every=None):
+    """
+    Starts the fake ocr service on a background thread.
+    :param port: port to listen on, 0 picks a free one
+    :param latency: seconds each request takes
+    :param fail_every: when set, every n-th request gets a 503 response
+    :return: running FakeOcrServer; call shutdown() to stop it
+    """
+    server = FakeOcrServer(port, latency, fail_every)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    return server
+
+
+def benchmark_ocr_client(n_pages, concurrency_levels, latency, fail_every=None):
+    """
+    Times OcrClient.query_many against the fake server at several concurrency levels.
+    :return: list of (concurrency, seconds, pages per second, errors) tuples
+    """
+    from ocr_pipeline import OcrClient
+
+    server = start_fake_ocr_server(latency=latency, fail_every=fail_every)
+    image_urls = ['http://example.com/page_' + str(page_n) + '.jpeg' for page_n in range(n_pages)]
+    timings = []
+    try:
+        for concurrency in concurrency_levels:
+            ocr_client = OcrClient(server.api_entry_point, max_concurrency=concurrency, backoff=0.05)
+            start = time.time()
+            errors = sum(1 for _, _, error in ocr_client.query_many(image_urls) if error)
+            elapsed = time.time() - start
+            timings.append((concurrency, elapsed, n_pages / elapsed, errors))
+    finally:
+        server.shutdown()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the pooled ocr client against a local fake ocr service')
+    parser.add_argument('--pages', help='number of page requests per run', type=int, default=200)
+    parser.add_argument('--concurrency', help='concurrency levels to compare', type=int, nargs='+',
+                        default=[1, 8, 32])
+    parser.add_argument('--latency', help='seconds the fake service takes per request', type=float, default=0.05)
+    parser.add_argument('--fail-every', help='answer every n-th request with a 503', type=int, default=None)
+    args = parser.parse_args()
+    for concurrency, elapsed, pages_per_second, errors in benchmark_ocr_client(args.pages, args.concurrency,
+                                                                              args.latency, args.fail_every):
+        print('concurrency %d: %.2fs, %.1f pages/s, %d errors' % (concurrency, elapsed, pages_per_second, errors))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import atexit
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+"""
+Lightweight timing and throughput metrics for the pipeline entry points. Instrumented functions record their call
+count, error count and a latency histogram; some also record bytes read and written, and functions returning an
+error report count each failed item as an error. Metrics are off by default, and an instrumented call then costs
+a single flag check. Set SHINING_METRICS to an output path (a .prom file for the prometheus text format, json
+otherwise) or call enable_metrics() to turn them on.
+Metrics are collected per process; work done inside process pool workers is timed as part of the call that
+started the pool.
+"""
+
+latency_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+metrics_enabled = False
+metrics_lock = threading.Lock()
+metrics = {}
+
+
+def new_metric():
+    return {
+        'calls': 0,
+        'errors': 0,
+        'latency_sum': 0.0,
+        'latency_max': 0.0,
+        'latency_counts': [0] * (len(latency_buckets) + 1),
+        'bytes_read': 0,
+        'bytes_written': 0
+    }
+
+
+def enable_metrics(output_path=None):
+    """
+    Turns metric collection on.
+    :param output_path: optional file the metrics are written to when the interpreter exits, see write_metrics
+    """
+    global metrics_enabled
+    metrics_enabled = True
+    if output_path:
+        atexit.register(write_metrics, output_path)
+
+
+def disable_metrics():
+    global metrics_enabled
+    metrics_enabled = False
+
+
+def reset_metrics():
+    with metrics_lock:
+        metrics.clear()
+
+
+def record_call(name, elapsed, failed=False):
+    with metrics_lock:
+        metric = metrics.get(name) or metrics.setdefault(name, new_metric())
+        metric['calls'] += 1
+        metric['errors'] += int(failed)
+        metric['latency_sum'] += elapsed
+        metric['latency_max'] = max(metric['latency_max'], elapsed)
+        metric['latency_counts'][bisect_left(latency_buckets, elapsed)] += 1
+
+
+def record_bytes(name, bytes_read=0, bytes_written=0):
+    """
+    Adds to the bytes read and written by an instrumented function. Does nothing while metrics are off.
+    """
+    if not metrics_enabled:
+        return
+    with metrics_lock:
+        metric = metrics.get(name) or metrics.setdefault(name, new_metric())
+        metric['bytes_read'] += bytes_read
+        metric['bytes_written'] += bytes_written
+
+
+def record_report_errors(name, error_report):
+    """
+    Counts the failed items of an error report returned by an instrumented function as errors.
+    :param error_report: key:error dict, with None for items that succeeded
+    """
+    if not metrics_enabled:
+        return
+    with metrics_lock:
+        metric = metrics.get(name) or metrics.setdefault(name, new_metric())
+        metric['errors'] += sum(1 for error in error_report.values() if error)
+
+
+def file_size(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+
+def instrumented(name):
+    """
+    Decorator recording the call count, errors and latency of a function under the given metric name.
+    A call that raises counts as an error.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not metrics_enabled:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                record_call(name, time.time() - start, failed=True)
+                raise
+            record_call(name, time.time() - start)
+            return result
+        return wrapper
+    return decorator
+
+
+def get_metrics():
+    """
+    :return: name:metric dict; each latency histogram is a list of cumulative (upper bound, count) pairs
+    """
+    with metrics_lock:
+        snapshot = {}
+        for name, metric in metrics.items():
+            metric_snapshot = dict(metric)
+            del metric_snapshot['latency_counts']
+            cumulative_count = 0
+            histogram = []
+            for upper_bound, count in zip(latency_buckets + ('+Inf',), metric['latency_counts']):
+                cumulative_count += count
+                histogram.append((upper_bound, cumulative_count))
+            metric_snapshot['latency_histogram'] = histogram
+            snapshot[name] = metric_snapshot
+    return snapshot
+
+
+def format_prometheus(metrics_snapshot):
+    lines = []
+
+    def add_metric(metric_name, metric_type, samples):
+        lines.append('# TYPE shining_' + metric_name + ' ' + metric_type)
+        for sample_suffix, labels, value in samples:
+            label_text = ','.join('%s="%s"' % label for label in labels)
+            lines.append('shining_%s%s{%s} %s' % (metric_name, sample_suffix, label_text, repr(value)))
+
+    names = sorted(metrics_snapshot)
+    add_metric('calls_total', 'counter', [('', [('function', name)], metrics_snapshot[name]['calls'])
+                                          for name in names])
+    add_metric('errors_total', 'counter', [('', [('function', name)], metrics_snapshot[name]['errors'])
+                                           for name in names])
+    add_metric('bytes_read_total', 'counter', [('', [('function', name)], metrics_snapshot[name]['bytes_read'])
+                                               for name in names])
+    add_metric('bytes_written_total', 'counter',
+               [('', [('function', name)], metrics_snapshot[name]['bytes_written']) for name in names])
+    latency_samples = []
+    for name in names:
+        metric = metrics_snapshot[name]
+        for upper_bound, count in metric['latency_histogram']:
+            latency_samples.append(('_bucket', [('function', name), ('le', str(upper_bound))], count))
+        latency_samples.append(('_sum', [('function', name)], metric['latency_sum']))
+        latency_samples.append(('_count', [('function', name)], metric['calls']))
+    add_metric('latency_seconds', 'histogram', latency_samples)
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(output_path, output_format=None):
+    """
+    Writes the current metrics to a file.
+    :param output_path: destination file
+    :param output_format: 'json' or 'prometheus'; by default prometheus for .prom files and json otherwise
+    """
+    output_format = output_format or ('prometheus' if output_path.endswith('.prom') else 'json')
+    metrics_snapshot = get_metrics()
+    if output_format == 'prometheus':
+        body = format_prometheus(metrics_snapshot)
+    else:
+        body = json.dumps(metrics_snapshot, indent=2, sort_keys=True)
+    temp_path = output_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(body)
+    os.rename(temp_path, output_path)
+
+
+if os.environ.get('SHINING_METRICS'):
+    enable_metrics(os.environ['SHINING_METRICS'])
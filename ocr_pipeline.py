@@ -1,13 +1,28 @@
 import requests
+import requests.adapters
 import json
 import jsonschema
 import os
+import stat
+import sys
+import struct
+import glob
+import hashlib
+import threading
+import time
+import multiprocessing
+import Queue
+from multiprocessing.pool import ThreadPool
 from binascii import b2a_hex
 import PIL.Image as Image
+import PIL.ImageChops as ImageChops
 import io
+from cStringIO import StringIO
 
 from collections import OrderedDict
 from collections import defaultdict
+from collections import namedtuple
+from itertools import islice
 import pdfminer
 from pdfminer.pdfparser import PDFParser
 from pdfminer.pdfdocument import PDFDocument
@@ -16,8 +31,13 @@ from pdfminer.pdfinterp import PDFResourceManager
 from pdfminer.pdfinterp import PDFPageInterpreter
 from pdfminer.layout import LAParams
 from pdfminer.converter import PDFPageAggregator
+from pdfminer.pdftypes import resolve1, dict_value, int_value, list_value, PDFStream
+from pdfminer.pdfinterp import LITERAL_FORM, LITERAL_IMAGE
+from pdfminer.pdfpage import LITERAL_PAGE, LITERAL_PAGES
 
 from annotation_schema import page_schema
+import instrumentation
+from instrumentation import instrumented
 
 
 def determine_image_type (stream_first_4_bytes):
@@ -47,11 +67,11 @@ def save_image(lt_image, page_n, book, images_folder):
     return result
 
 
-def scale_and_save_image(pdf_page_image, page_n, book, images_folder, scale_factor):
+def scale_and_save_image(pdf_page_image, page_n, book, images_folder, scale_factor, resample='quality'):
     result = None
     file_ext = '.jpeg'
     file_name = book + '_' + str(page_n) + file_ext
-    file_stream = scale_image(pdf_page_image, scale_factor)
+    file_stream = scale_image(pdf_page_image, scale_factor, resample)
     if file_stream.size:
         file_stream.save(images_folder + '/' + file_name, format="JPEG")
 
@@ -68,36 +88,262 @@ def write_file(folder, filename, filedata, flags='w'):
     return result
 
 
-def scale_image(pdf_page_image, scale_factor):
-    page_image = Image.open(io.BytesIO(pdf_page_image.stream.get_rawdata()))
+resample_filters = {
+    'quality': Image.ANTIALIAS,
+    'balanced': Image.BILINEAR,
+    'fast': Image.NEAREST
+}
+
+
+def scale_image(pdf_page_image, scale_factor, resample='quality'):
+    return scale_image_data(pdf_page_image.stream.get_rawdata(), scale_factor, resample)
+
+
+def thumbnail_size(image_size, max_size):
+    """
+    The size Image.thumbnail shrinks an image of image_size to, so scaled pages keep their old dimensions.
+    """
+    x, y = image_size
+    if x > max_size[0]:
+        y = int(max(y * max_size[0] / x, 1))
+        x = int(max_size[0])
+    if y > max_size[1]:
+        x = int(max(x * max_size[1] / y, 1))
+        y = int(max_size[1])
+    return x, y
+
+
+def scale_image_data(image_data, scale_factor, resample='quality'):
+    """
+    Decodes a page image straight to grayscale at the smallest size the decoder offers that still covers the
+    scaled size, then resamples it to the scaled size.
+    For JPEGs, draft() makes libjpeg skip color conversion and use DCT scaling (1/2, 1/4 or 1/8) where the scale
+    factor allows it. cStringIO wraps the raw stream without copying it.
+    :param image_data: encoded image bytes
+    :param scale_factor: fraction of the original size
+    :param resample: 'quality', 'balanced' or 'fast' resampling filter
+    :return: grayscale PIL image
+    """
+    page_image = Image.open(StringIO(image_data))
+    img_dim = thumbnail_size(page_image.size, tuple([int(dim*scale_factor) for dim in page_image.size]))
+    page_image.draft('L', img_dim)
+    page_image.load()
+    if page_image.mode != 'L':
+        page_image = page_image.convert('L')
+    if page_image.size != img_dim:
+        page_image = page_image.resize(img_dim, resample_filters[resample])
+    return page_image
+
+
+def scale_image_full_decode(image_data, scale_factor):
+    """
+    The previous scaling path: a full color decode, antialiased thumbnail, then grayscale conversion.
+    Kept as the baseline for benchmark_scale_image.
+    """
+    page_image = Image.open(io.BytesIO(image_data))
     img_dim = tuple([int(dim*scale_factor) for dim in page_image.size])
     page_image.thumbnail(img_dim, Image.ANTIALIAS)
     return page_image.convert('L')
 
 
+def benchmark_scale_image(image_paths, scale_factor=0.66, resample='quality', repeats=3):
+    """
+    Compares scale_image_data with the full-decode path on real page images.
+    :param image_paths: page image files
+    :return: dict of seconds per image for each path, the speedup, and the mean absolute pixel difference
+    """
+    images_data = []
+    for image_path in image_paths:
+        with open(image_path, 'rb') as f:
+            images_data.append(f.read())
+
+    def time_path(scale):
+        start = time.time()
+        for _ in range(repeats):
+            for image_data in images_data:
+                scale(image_data)
+        return (time.time() - start) / (repeats * len(images_data))
+
+    full_decode_seconds = time_path(lambda image_data: scale_image_full_decode(image_data, scale_factor))
+    reduced_decode_seconds = time_path(lambda image_data: scale_image_data(image_data, scale_factor, resample))
+    pixel_diffs = []
+    for image_data in images_data:
+        full_decode = scale_image_full_decode(image_data, scale_factor)
+        reduced_decode = scale_image_data(image_data, scale_factor, resample)
+        histogram = ImageChops.difference(full_decode, reduced_decode).histogram()
+        pixel_diffs.append(sum(level * count for level, count in enumerate(histogram)) / float(sum(histogram)))
+    return {
+        'full_decode_seconds': full_decode_seconds,
+        'reduced_decode_seconds': reduced_decode_seconds,
+        'speedup': full_decode_seconds / reduced_decode_seconds,
+        'mean_pixel_diff': sum(pixel_diffs) / len(pixel_diffs)
+    }
+
+
 def record_image_size(pdf_page_image):
     page_image = Image.open(io.BytesIO(pdf_page_image))
     img_dim = page_image.size
     return img_dim
 
 
-def write_image_file(layout, page_n, book, dir_name, scale_factor=0):
+def read_image_dimensions(file_path):
+    """
+    Reads an image's width and height from its JPEG, PNG, GIF or BMP header without decoding it.
+    :param file_path: image file
+    :return: (width, height), or None if the header couldn't be read
+    """
+    with open(file_path, 'rb') as f:
+        header = f.read(26)
+        file_type = determine_image_type(header[0:4])
+        if file_type == '.png' and len(header) >= 24:
+            return struct.unpack('>II', header[16:24])
+        elif file_type == '.gif' and len(header) >= 10:
+            return struct.unpack('<HH', header[6:10])
+        elif file_type == '.bmp' and len(header) >= 26:
+            if struct.unpack('<I', header[14:18])[0] == 12:
+                return struct.unpack('<HH', header[18:22])
+            width, height = struct.unpack('<ii', header[18:26])
+            return width, abs(height)
+        elif file_type == '.jpeg':
+            return read_jpeg_dimensions(f)
+    return None
+
+
+def read_jpeg_dimensions(f):
+    """
+    Walks the JPEG marker segments up to the first start-of-frame marker, which holds the image size.
+    :param f: JPEG file object
+    :return: (width, height), or None if no frame header was found
+    """
+    # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC) which share the range
+    start_of_frame_markers = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+    standalone_markers = set(range(0xD0, 0xDA)) | {0x01}
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != '\xff':
+            continue
+        marker = f.read(1)
+        while marker == '\xff':
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = ord(marker)
+        if marker in standalone_markers:
+            continue
+        segment_length = f.read(2)
+        if len(segment_length) < 2:
+            return None
+        if marker in start_of_frame_markers:
+            frame_header = f.read(5)
+            if len(frame_header) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame_header[1:5])
+            return width, height
+        f.seek(struct.unpack('>H', segment_length)[0] - 2, 1)
+
+
+def build_image_dim_index(image_dir, index_path):
+    """
+    Builds the img_dim_lookup make_diagram_hit_urls needs, from a persistent index of image sizes.
+    Sizes are read from the image headers, and only for files whose mtime or byte size changed since the index was
+    last saved; files that can't be parsed that way fall back to PIL.
+    :param image_dir: directory of diagram images
+    :param index_path: json file the index is kept in
+    :return: image name:(width, height) dict
+    """
+    try:
+        with open(index_path, 'r') as f:
+            dim_index = json.load(f)
+    except (IOError, ValueError):
+        dim_index = {}
+
+    updated_index = {}
+    for image_name in os.listdir(image_dir):
+        image_path = os.path.join(image_dir, image_name)
+        stats = os.stat(image_path)
+        if not stat.S_ISREG(stats.st_mode):
+            continue
+        indexed = dim_index.get(image_name)
+        if indexed and indexed['mtime'] == stats.st_mtime and indexed['size'] == stats.st_size:
+            updated_index[image_name] = indexed
+            continue
+        img_dim = read_image_dimensions(image_path)
+        if not img_dim:
+            try:
+                with open(image_path, 'rb') as f:
+                    img_dim = record_image_size(f.read())
+            except IOError:
+                continue
+        updated_index[image_name] = {'mtime': stats.st_mtime, 'size': stats.st_size, 'dim': list(img_dim)}
+
+    if updated_index != dim_index:
+        temp_path = index_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            json.dump(updated_index, f)
+        os.rename(temp_path, index_path)
+    return {image_name: tuple(indexed['dim']) for image_name, indexed in updated_index.items()}
+
+
+PageImage = namedtuple('PageImage', ['stream'])
+
+
+def find_page_image(page):
+    """
+    Looks up a page's embedded image XObject directly in its resources, descending into form XObjects, without
+    running the page content through layout analysis.
+    :param page: pdfminer PDFPage
+    :return: PageImage wrapping the image stream, or None unless the page holds exactly one image
+    """
+    image_streams = []
+
+    def collect_images(resources, seen):
+        xobjects = dict_value(resolve1(resources).get('XObject', {})) if resources else {}
+        for xobject_ref in xobjects.values():
+            xobject = resolve1(xobject_ref)
+            if not isinstance(xobject, PDFStream) or id(xobject) in seen:
+                continue
+            seen.add(id(xobject))
+            if xobject.get('Subtype') is LITERAL_IMAGE:
+                image_streams.append(xobject)
+            elif xobject.get('Subtype') is LITERAL_FORM:
+                collect_images(xobject.get('Resources'), seen)
+
+    collect_images(page.resources, set())
+    if len(image_streams) != 1:
+        return None
+    return PageImage(image_streams[0])
+
+
+def write_image_file(layout, page_n, book, dir_name, scale_factor=0, resample='quality'):
     figure_detections = [detection for detection in layout._objs if type(detection) == pdfminer.layout.LTFigure][0]
     page_image = figure_detections._objs[0]
+    write_page_image(page_image, page_n, book, dir_name, scale_factor, resample)
+    return
+
+
+def write_page_image(page_image, page_n, book, dir_name, scale_factor=0, resample='quality'):
     if not scale_factor:
         save_image(page_image, page_n, book, dir_name)
     else:
-        scale_and_save_image(page_image, page_n, book, dir_name, scale_factor)
+        scale_and_save_image(page_image, page_n, book, dir_name, scale_factor, resample)
     return
 
 
+# compiled once and shared by every annotation write and validation
+page_validator = jsonschema.Draft4Validator(page_schema)
+
+
 def write_annotation_file(ocr_results, page_n, book, annotations_folder):
 
     def point_to_tuple(box):
         return tuple(OrderedDict(sorted(box.items())).values())
 
     def get_bbox_tuples(detection):
-        return map(point_to_tuple, detection['rectangle'])
+        # lists rather than tuples, so the annotation validates as json arrays without a json round trip
+        return [list(point_to_tuple(point)) for point in detection['rectangle']]
 
     ids = 1
     annotation = defaultdict(defaultdict)
@@ -128,8 +374,7 @@ def write_annotation_file(ocr_results, page_n, book, annotations_folder):
     annotation['figure'] = {}
     annotation['relationship'] = {}
 
-    validator = jsonschema.Draft4Validator(page_schema)
-    validator.validate(json.loads(json.dumps(annotation)))
+    page_validator.validate(annotation)
 
     file_ext = ".json"
     file_path = annotations_folder + '/' + book + '_' + str(page_n) + file_ext
@@ -138,12 +383,45 @@ def write_annotation_file(ocr_results, page_n, book, annotations_folder):
     return
 
 
+def validate_annotation_file(file_path):
+    """
+    :param file_path: annotation json file
+    :return: the file path and a list of every schema error in it
+    """
+    try:
+        with open(file_path, 'r') as f:
+            annotation = json.load(f)
+    except (IOError, ValueError) as e:
+        return file_path, [repr(e)]
+    errors = sorted(page_validator.iter_errors(annotation), key=lambda error: list(error.path))
+    return file_path, ['/'.join(str(key) for key in error.path) + ': ' + error.message for error in errors]
+
+
+def validate_annotation_dir(annotation_dir, workers=None):
+    """
+    Validates every annotation file in a directory against the page schema, spread across a process pool.
+    :param annotation_dir: directory of annotation json files
+    :param workers: number of processes, defaults to the number of cores
+    :return: file path:errors dict for the files with at least one error
+    """
+    annotation_files = sorted(glob.glob(os.path.join(annotation_dir, '*.json')))
+    pool = multiprocessing.Pool(workers)
+    try:
+        file_errors = pool.imap_unordered(validate_annotation_file, annotation_files, chunksize=32)
+        return {file_path: errors for file_path, errors in file_errors if errors}
+    finally:
+        pool.terminate()
+
+
+ocr_api_entry_point = 'http://vision-ocr.dev.allenai.org/v1/ocr'
+
+
 def query_vision_ocr(image_url, merge_boxes=False, include_merged_components=False, as_json=True):
     print image_url
     req = requests.get(image_url)
     tpi = Image.open(io.BytesIO(req.content))
     print(tpi.info, tpi.size, tpi.size[0]*tpi.size[1])
-    api_entry_point = 'http://vision-ocr.dev.allenai.org/v1/ocr'
+    api_entry_point = ocr_api_entry_point
     header = {'Content-Type': 'application/json'}
     request_data = {
         'url': image_url,
@@ -161,28 +439,242 @@ def query_vision_ocr(image_url, merge_boxes=False, include_merged_components=Fal
     return response
 
 
+class OcrClient(object):
+    """
+    Pooled client for the vision ocr service. Requests share one keep-alive session, run at most max_concurrency at
+    a time, time out, and are retried with exponential backoff on connection errors and 429/5xx responses.
+    Unlike query_vision_ocr it does not download the page image itself; the service fetches it from the url.
+    :param api_entry_point: ocr endpoint, e.g. the url of a fake_ocr_server for offline runs
+    :param max_concurrency: number of requests in flight (and pooled connections)
+    :param timeout: seconds to wait for the service to respond
+    :param max_retries: retries per page before giving up
+    :param backoff: seconds before the first retry, doubled on every further retry
+    """
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, api_entry_point=ocr_api_entry_point, max_concurrency=8, timeout=60, max_retries=4,
+                 backoff=0.5):
+        self.api_entry_point = api_entry_point
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @instrumented('ocr_query')
+    def query(self, image_url, merge_boxes=False, include_merged_components=False):
+        """
+        :param image_url: url of the page image
+        :return: the ocr service's json response
+        """
+        request_data = json.dumps({
+            'url': image_url,
+            'mergeBoxes': merge_boxes,
+            'includeMergedComponents': include_merged_components
+        })
+        header = {'Content-Type': 'application/json'}
+        attempt = 0
+        while True:
+            try:
+                response = self.session.post(self.api_entry_point, data=request_data, headers=header,
+                                             timeout=self.timeout)
+                if response.status_code not in self.retry_statuses:
+                    response.raise_for_status()
+                    instrumentation.record_bytes('ocr_query', len(response.content), len(request_data))
+                    return response.json()
+                error = requests.HTTPError(str(response.status_code) + ' ' + str(response.reason))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt >= self.max_retries:
+                raise error
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    def query_many(self, image_urls, **query_options):
+        """
+        Queries the service for many pages concurrently.
+        :param image_urls: iterable of page image urls
+        :param query_options: merge_boxes / include_merged_components, see query
+        :return: generator of (url, response, error) tuples in completion order; response is None on error
+        """
+        def query_page(image_url):
+            try:
+                return image_url, self.query(image_url, **query_options), None
+            except Exception as e:
+                return image_url, None, repr(e)
+
+        pool = ThreadPool(self.max_concurrency)
+        try:
+            for result in pool.imap_unordered(query_page, image_urls):
+                yield result
+        finally:
+            pool.terminate()
+
+
+def count_pages(document):
+    """
+    Reads the page count from the root of the document's page tree. Documents without a /Pages root or /Count
+    have their pages counted with PDFPage.create_pages instead, which falls back to scanning the objects.
+    :param document: pdfminer PDFDocument
+    :return: number of pages
+    """
+    if 'Pages' in document.catalog:
+        page_tree = dict_value(document.catalog['Pages'])
+        if 'Count' in page_tree:
+            return int_value(page_tree['Count'])
+    return sum(1 for _ in PDFPage.create_pages(document))
+
+
+def iter_pages_in_range(document, first_page, last_page):
+    """
+    Walks the document's page tree straight to a range of pages. Page tree nodes that end before first_page are
+    skipped using their /Count without loading their pages, and the walk stops once last_page is reached.
+    :param document: pdfminer PDFDocument
+    :param first_page: first page number to yield
+    :param last_page: last page number to yield
+    :return: generator of (page_n, PDFPage) tuples
+    """
+    if 'Pages' not in document.catalog:
+        pages = islice(enumerate(PDFPage.create_pages(document)), first_page, last_page + 1)
+        for page_n, page in pages:
+            yield page_n, page
+        return
+
+    page_n = 0
+    to_visit = [(document.catalog['Pages'], document.catalog)]
+    while to_visit and page_n <= last_page:
+        node_ref, parent = to_visit.pop()
+        node = dict_value(node_ref)
+        if node.get('Type') is LITERAL_PAGES and 'Kids' in node:
+            n_node_pages = int_value(node.get('Count', 0))
+            if n_node_pages and page_n + n_node_pages <= first_page:
+                page_n += n_node_pages
+                continue
+            node = inherit_page_attrs(node, parent)
+            to_visit.extend((kid, node) for kid in reversed(list_value(node['Kids'])))
+        elif node.get('Type') is LITERAL_PAGE:
+            if page_n >= first_page:
+                yield page_n, PDFPage(document, getattr(node_ref, 'objid', node_ref), inherit_page_attrs(node, parent))
+            page_n += 1
+
+
+def inherit_page_attrs(node, parent):
+    """
+    Copies the page attributes a page tree node inherits from its parent, as PDFPage.create_pages does.
+    """
+    node = node.copy()
+    for k, v in parent.iteritems():
+        if k in PDFPage.INHERITABLE_ATTRS and k not in node:
+            node[k] = v
+    return node
+
+
+def render_pages(pdf_path, page_numbers, laparams, book_name, images_folder, scale_factor, extraction='direct',
+                 resample='quality'):
+    """
+    Opens a book and writes the page image of each requested page.
+    :param pdf_path: path to the book pdf
+    :param page_numbers: sorted list of page numbers to render
+    :param laparams: pdfminer LAParams for the layout analysis
+    :param book_name: book name used in the image file names
+    :param images_folder: destination dir
+    :param scale_factor: image scaling, 0 saves the embedded image unchanged
+    :param extraction: 'direct' takes each page's image XObject straight from the page resources and only runs
+    layout analysis on pages where that lookup doesn't find a single image. 'layout' always runs layout analysis.
+    :param resample: 'quality', 'balanced' or 'fast' resampling when scaling, see scale_image_data
+    :return: page_n:error dict, with None for pages rendered successfully
+    """
+    page_report = {}
+    if not page_numbers:
+        return page_report
+    wanted_pages = set(page_numbers)
+    with open(pdf_path, 'rb') as fp:
+        parser = PDFParser(fp)
+        document = PDFDocument(parser)
+        rsrcmgr = PDFResourceManager()
+        device = PDFPageAggregator(rsrcmgr, laparams=laparams)
+        interpreter = PDFPageInterpreter(rsrcmgr, device)
+
+        for page_n, page in iter_pages_in_range(document, page_numbers[0], page_numbers[-1]):
+            if page_n not in wanted_pages:
+                continue
+            try:
+                page_image = find_page_image(page) if extraction == 'direct' else None
+                if page_image:
+                    write_page_image(page_image, page_n, book_name, images_folder, scale_factor, resample)
+                else:
+                    interpreter.process_page(page)
+                    layout = device.get_result()
+                    write_image_file(layout, page_n, book_name, images_folder, scale_factor, resample)
+                page_report[page_n] = None
+            except Exception as e:
+                page_report[page_n] = repr(e)
+    return page_report
+
+
+def render_page_chunk(render_job):
+    """
+    Process pool task for process_book.
+    :param render_job: tuple of render_pages arguments
+    :return: page_n:error dict
+    """
+    return render_pages(*render_job)
+
+
+@instrumented('process_book')
 def process_book(pdf_file, page_range, line_overlap,
                  char_margin,
                  line_margin,
                  word_margin,
-                 boxes_flow):
+                 boxes_flow,
+                 workers=1,
+                 extraction='direct',
+                 resample='quality'):
+    """
+    Writes a scaled image of every page in a textbook pdf.
+    :param workers: number of processes to split the page range across. Each one opens the book itself.
+    :param extraction: 'direct' or 'layout' page image lookup, see render_pages
+    :param resample: 'quality', 'balanced' or 'fast' resampling when scaling, see scale_image_data
+    :return: page_n:error dict, with None for pages rendered successfully
+    """
     line_overlap = 0.5
     source_dir = 'pdfs/'
+    images_folder = 'smaller_page_images'
+    scale_factor = 0.66
     book_name = pdf_file.replace('.pdf', '')
     laparams = LAParams(line_overlap, char_margin, line_margin, word_margin, boxes_flow)
+    pdf_path = source_dir + pdf_file
 
-    with open(source_dir + pdf_file, 'r') as fp:
-        parser = PDFParser(fp)
-        document = PDFDocument(parser)
-        rsrcmgr = PDFResourceManager()
-        device = PDFPageAggregator(rsrcmgr, laparams=laparams)
-        interpreter = PDFPageInterpreter(rsrcmgr, device)
+    with open(pdf_path, 'rb') as fp:
+        n_pages = count_pages(PDFDocument(PDFParser(fp)))
+    if page_range:
+        page_numbers = range(max(page_range[0], 0), min(page_range[1], n_pages - 1) + 1)
+    else:
+        page_numbers = range(n_pages)
 
-        for page_n, page in enumerate(PDFPage.create_pages(document)):
-            if not page_range or (page_range[0] <= page_n <= page_range[1]):
-                interpreter.process_page(page)
-                layout = device.get_result()
-                write_image_file(layout, page_n, book_name, 'smaller_page_images', 0.66)
+    if workers == 1:
+        page_report = render_pages(pdf_path, page_numbers, laparams, book_name, images_folder, scale_factor,
+                                   extraction, resample)
+    else:
+        chunk_size = max(1, len(page_numbers) // (workers * 4))
+        render_jobs = [(pdf_path, page_numbers[i:i + chunk_size], laparams, book_name, images_folder, scale_factor,
+                        extraction, resample) for i in range(0, len(page_numbers), chunk_size)]
+        page_report = {}
+        pool = multiprocessing.Pool(workers)
+        try:
+            for chunk_report in pool.imap_unordered(render_page_chunk, render_jobs):
+                page_report.update(chunk_report)
+        finally:
+            pool.terminate()
+    instrumentation.record_report_errors('process_book', page_report)
+    if instrumentation.metrics_enabled:
+        instrumentation.record_bytes('process_book', instrumentation.file_size(pdf_path),
+                                     sum(instrumentation.file_size(page_image_path(images_folder, page_n, book_name))
+                                         for page_n, error in page_report.items() if not error))
+    return page_report
 
 
 def assemble_url(page_number, book_name, base_url):
@@ -197,22 +689,364 @@ def check_response(url):
         return False
 
 
-def perform_ocr(pdf_file, annotation_dir, (start_n, stop_n)):
-    book_name = pdf_file.replace('.pdf', '')
+page_image_base_url = 'https://s3-us-west-2.amazonaws.com/ai2-vision-turk-data/textbook-annotation-test/smaller-page-images/'
 
-    base_url = 'https://s3-us-west-2.amazonaws.com/ai2-vision-turk-data/textbook-annotation-test/smaller-page-images/'
 
-    page_n = start_n
-    while page_n <= stop_n:
+@instrumented('perform_ocr')
+def perform_ocr(pdf_file, annotation_dir, (start_n, stop_n), ocr_client=None, base_url=page_image_base_url,
+                ocr_cache=None, image_dir='smaller_page_images', merge_boxes=False, include_merged_components=False):
+    """
+    Runs ocr on every page in the range that doesn't have an annotation yet and writes the annotation files.
+    :param ocr_client: OcrClient to send the requests through, defaults to one with 8 concurrent requests
+    :param base_url: location the page images are served from
+    :param ocr_cache: optional OcrResponseCache. Pages whose local image has a cached response aren't sent to the
+    service, and new responses are added to the cache.
+    :param image_dir: local copies of the page images, used to compute the cache keys
+    :return: page_n:error dict, with None for pages annotated successfully
+    """
+    book_name = pdf_file.replace('.pdf', '')
+    ocr_client = ocr_client or OcrClient()
+    query_options = {'merge_boxes': merge_boxes, 'include_merged_components': include_merged_components}
+
+    page_report = {}
+    pages_by_url = {}
+    for page_n in range(start_n, stop_n + 1):
         file_ext = ".json"
         file_path = annotation_dir + '/' + book_name + '_' + str(page_n) + file_ext
-        if not os.path.isfile(file_path):
+        if os.path.isfile(file_path):
+            continue
+        cache_key = None
+        if ocr_cache and os.path.isfile(page_image_path(image_dir, page_n, book_name)):
+            with open(page_image_path(image_dir, page_n, book_name), 'rb') as f:
+                cache_key = ocr_cache.make_key(f.read(), **query_options)
+            ocr_response = ocr_cache.get(cache_key)
+            if ocr_response is not None:
+                page_report[page_n] = write_ocr_annotation(ocr_response, page_n, book_name, annotation_dir)
+                continue
+        pages_by_url[assemble_url(page_n, book_name, base_url)] = (page_n, cache_key)
+
+    for image_url, ocr_response, error in ocr_client.query_many(pages_by_url.keys(), **query_options):
+        page_n, cache_key = pages_by_url[image_url]
+        if not error:
+            if cache_key:
+                ocr_cache.put(cache_key, ocr_response)
+            error = write_ocr_annotation(ocr_response, page_n, book_name, annotation_dir)
+        else:
+            print('ocr service error', book_name, page_n, error)
+        page_report[page_n] = error
+    instrumentation.record_report_errors('perform_ocr', page_report)
+    if instrumentation.metrics_enabled:
+        instrumentation.record_bytes('perform_ocr', bytes_written=sum(
+            instrumentation.file_size(annotation_dir + '/' + book_name + '_' + str(page_n) + '.json')
+            for page_n, error in page_report.items() if not error))
+    return page_report
+
+
+def write_ocr_annotation(ocr_response, page_n, book_name, annotation_dir):
+    try:
+        write_annotation_file(ocr_response, page_n, book_name, annotation_dir)
+        return None
+    except Exception as e:
+        print('annotation error', book_name, page_n, e)
+        return repr(e)
+
+
+class OcrResponseCache(object):
+    """
+    On-disk cache of raw ocr service responses, keyed by a hash of the page image's content together with the
+    request options, so the same image gets a cache hit under any book name or url. Every hit refreshes the
+    entry's mtime, and once the cache grows past max_bytes the least recently used entries are evicted.
+    :param cache_dir: directory the responses are stored in
+    :param max_bytes: size cap for the cached responses
+    """
+    def __init__(self, cache_dir, max_bytes=1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.total_bytes = sum(size for _, size, _ in self.list_entries())
+
+    @staticmethod
+    def make_key(image_data, merge_boxes=False, include_merged_components=False):
+        options = json.dumps({'mergeBoxes': merge_boxes, 'includeMergedComponents': include_merged_components},
+                             sort_keys=True)
+        return hashlib.sha1(image_data).hexdigest() + '_' + hashlib.sha1(options).hexdigest()[:12]
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def list_entries(self):
+        entries = []
+        for sub_dir, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                if file_name.endswith('.json'):
+                    stats = os.stat(os.path.join(sub_dir, file_name))
+                    entries.append((stats.st_mtime, stats.st_size, os.path.join(sub_dir, file_name)))
+        return entries
+
+    def get(self, key):
+        """
+        :return: the cached response, or None
+        """
+        file_path = self.entry_path(key)
+        try:
+            with open(file_path, 'r') as f:
+                ocr_response = json.load(f)
+            os.utime(file_path, None)
+            return ocr_response
+        except (IOError, OSError, ValueError):
+            return None
 
-            print(book_name, page_n)
+    def put(self, key, ocr_response):
+        file_path = self.entry_path(key)
+        if not os.path.isdir(os.path.dirname(file_path)):
             try:
-                print(assemble_url(page_n, book_name, base_url))
-                ocr_response = query_vision_ocr(assemble_url(page_n, book_name, base_url))
-                write_annotation_file(ocr_response, page_n, book_name, annotation_dir)
-            except ValueError:
-                print('ocr service error')
-        page_n += 1
+                os.makedirs(os.path.dirname(file_path))
+            except OSError:
+                pass
+        body = json.dumps(ocr_response)
+        temp_path = file_path + '.' + str(os.getpid()) + '.' + str(threading.current_thread().ident) + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(body)
+        os.rename(temp_path, file_path)
+        with self.lock:
+            self.total_bytes += len(body)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache is back under 90% of its cap.
+        """
+        entries = sorted(self.list_entries())
+        self.total_bytes = sum(size for _, size, _ in entries)
+        for _, size, file_path in entries:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(file_path)
+                self.total_bytes -= size
+            except OSError:
+                pass
+
+
+def page_image_path(image_dir, page_n, book_name):
+    return os.path.join(image_dir, book_name + '_' + str(page_n) + '.jpeg')
+
+
+def regenerate_annotations(pdf_file, annotation_dir, (start_n, stop_n), ocr_cache, image_dir='smaller_page_images',
+                           merge_boxes=False, include_merged_components=False):
+    """
+    Rewrites the annotation files of a page range from cached ocr responses only, without any network calls.
+    Existing annotation files are overwritten.
+    :param ocr_cache: OcrResponseCache filled by earlier perform_ocr runs
+    :param image_dir: local page images the cache keys are computed from
+    :return: page_n:error dict, with None for pages rewritten successfully
+    """
+    book_name = pdf_file.replace('.pdf', '')
+    page_report = {}
+    for page_n in range(start_n, stop_n + 1):
+        try:
+            with open(page_image_path(image_dir, page_n, book_name), 'rb') as f:
+                cache_key = ocr_cache.make_key(f.read(), merge_boxes, include_merged_components)
+            ocr_response = ocr_cache.get(cache_key)
+            if ocr_response is None:
+                page_report[page_n] = 'not cached'
+                continue
+            write_annotation_file(ocr_response, page_n, book_name, annotation_dir)
+            page_report[page_n] = None
+        except Exception as e:
+            page_report[page_n] = repr(e)
+    return page_report
+
+
+class PipelineManifest(object):
+    """
+    Resumable record of how far each page of a book has got through run_page_pipeline. Pages move through
+    'rendered' and 'annotated', or end up 'failed' with the stage and error that stopped them.
+    :param manifest_path: json file the manifest is kept in
+    """
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.lock = threading.Lock()
+        try:
+            with open(manifest_path, 'r') as f:
+                self.pages = {int(page_n): page_state for page_n, page_state in json.load(f).items()}
+        except (IOError, ValueError):
+            self.pages = {}
+
+    def stage(self, page_n):
+        return self.pages.get(page_n, {}).get('stage')
+
+    def update(self, page_n, stage, error=None):
+        with self.lock:
+            self.pages[page_n] = {'stage': stage, 'error': error}
+            temp_path = self.manifest_path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                json.dump(self.pages, f)
+            os.rename(temp_path, self.manifest_path)
+
+
+def run_page_pipeline(pdf_file, annotation_dir, page_range=None, manifest_path=None, render_workers=2,
+                      ocr_workers=8, write_workers=1, queue_size=16, render_chunk_size=4, ocr_client=None,
+                      base_url=page_image_base_url, publish_image=None, ocr_cache=None, laparams=None,
+                      extraction='direct', resample='quality'):
+    """
+    Runs process_book and perform_ocr as one streaming pipeline. Pages flow from a render stage (a process pool)
+    through an ocr stage and an annotation-write stage (thread pools), with bounded queues between the stages, so
+    cpu-bound rendering overlaps network-bound ocr and a slow stage holds back the ones feeding it.
+    Progress is kept in a manifest; re-running skips annotated pages and sends pages that were rendered before
+    (including ones that failed in ocr or writing) straight back to ocr.
+    :param pdf_file: book pdf in the pdfs/ dir
+    :param annotation_dir: destination dir for the annotation files
+    :param page_range: optional (first, last) page numbers
+    :param manifest_path: manifest json file, defaults to pipeline_state/<book>_manifest.json. It's kept out of the
+    annotation and page image dirs so tools reading those dirs don't pick it up.
+    :param render_workers: processes rendering pages
+    :param ocr_workers: concurrent ocr requests
+    :param write_workers: threads writing annotation files
+    :param queue_size: capacity of each queue between stages
+    :param render_chunk_size: pages rendered per render task
+    :param ocr_client: OcrClient, defaults to one sized for ocr_workers
+    :param base_url: location the page images are served from
+    :param publish_image: optional function of a rendered image path that makes it available at base_url,
+    e.g. an s3 upload; it runs in the render stage
+    :param ocr_cache: optional OcrResponseCache
+    :param laparams: LAParams for pages that need layout analysis
+    :param extraction: 'direct' or 'layout' page image lookup, see render_pages
+    :param resample: 'quality', 'balanced' or 'fast' resampling when scaling, see scale_image_data
+    :return: page_n:state dict from the manifest. Errors outside the per-page handling, like a failed manifest
+    write, don't stop the other pages; the first one is re-raised after the pipeline has drained.
+    """
+    source_dir = 'pdfs/'
+    images_folder = 'smaller_page_images'
+    scale_factor = 0.66
+    book_name = pdf_file.replace('.pdf', '')
+    pdf_path = source_dir + pdf_file
+    laparams = laparams or LAParams(line_overlap=0.5)
+    if not manifest_path:
+        state_dir = 'pipeline_state'
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        manifest_path = os.path.join(state_dir, book_name + '_manifest.json')
+    manifest = PipelineManifest(manifest_path)
+    ocr_client = ocr_client or OcrClient(max_concurrency=ocr_workers)
+
+    with open(pdf_path, 'rb') as fp:
+        n_pages = count_pages(PDFDocument(PDFParser(fp)))
+    first_page, last_page = page_range or (0, n_pages - 1)
+    page_numbers = [page_n for page_n in range(max(first_page, 0), min(last_page, n_pages - 1) + 1)
+                    if manifest.stage(page_n) != 'annotated']
+    rendered_pages = [page_n for page_n in page_numbers if manifest.stage(page_n) and
+                      not (manifest.pages[page_n]['error'] or '').startswith('render') and
+                      os.path.isfile(page_image_path(images_folder, page_n, book_name))]
+    pages_to_render = sorted(set(page_numbers) - set(rendered_pages))
+
+    render_queue = Queue.Queue()
+    ocr_queue = Queue.Queue(queue_size)
+    write_queue = Queue.Queue(queue_size)
+    for i in range(0, len(pages_to_render), render_chunk_size):
+        render_queue.put(pages_to_render[i:i + render_chunk_size])
+
+    # exceptions that escaped a stage's own error handling, e.g. failed manifest writes. The stage threads keep
+    # consuming their queues so the pipeline always drains, and the first one is re-raised once it has.
+    pipeline_errors = []
+
+    def run_guarded(process_item, item):
+        try:
+            process_item(item)
+        except Exception:
+            pipeline_errors.append(sys.exc_info())
+
+    def render_chunk(chunk):
+        render_job = (pdf_path, chunk, laparams, book_name, images_folder, scale_factor, extraction, resample)
+        try:
+            chunk_report = render_pool.apply(render_page_chunk, (render_job,))
+        except Exception as e:
+            chunk_report = {page_n: repr(e) for page_n in chunk}
+        for page_n in chunk:
+            error = chunk_report.get(page_n, 'not rendered')
+            if not error and publish_image:
+                try:
+                    publish_image(page_image_path(images_folder, page_n, book_name))
+                except Exception as e:
+                    error = repr(e)
+            if error:
+                manifest.update(page_n, 'failed', 'render: ' + error)
+                continue
+            manifest.update(page_n, 'rendered')
+            ocr_queue.put(page_n)
+
+    def ocr_page(page_n):
+        try:
+            cache_key = None
+            ocr_response = None
+            if ocr_cache:
+                with open(page_image_path(images_folder, page_n, book_name), 'rb') as f:
+                    cache_key = ocr_cache.make_key(f.read())
+                ocr_response = ocr_cache.get(cache_key)
+            if ocr_response is None:
+                ocr_response = ocr_client.query(assemble_url(page_n, book_name, base_url))
+                if cache_key:
+                    ocr_cache.put(cache_key, ocr_response)
+        except Exception as e:
+            manifest.update(page_n, 'failed', 'ocr: ' + repr(e))
+            return
+        write_queue.put((page_n, ocr_response))
+
+    def write_page((page_n, ocr_response)):
+        error = write_ocr_annotation(ocr_response, page_n, book_name, annotation_dir)
+        if error:
+            manifest.update(page_n, 'failed', 'write: ' + error)
+        else:
+            manifest.update(page_n, 'annotated')
+
+    def render_stage():
+        while True:
+            try:
+                chunk = render_queue.get_nowait()
+            except Queue.Empty:
+                return
+            run_guarded(render_chunk, chunk)
+
+    def feed_rendered_pages():
+        for page_n in rendered_pages:
+            ocr_queue.put(page_n)
+
+    def consume_stage(stage_queue, process_item):
+        while True:
+            item = stage_queue.get()
+            if item is None:
+                return
+            run_guarded(process_item, item)
+
+    def start_threads(stage, n_threads, *stage_args):
+        threads = [threading.Thread(target=stage, args=stage_args) for _ in range(n_threads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return threads
+
+    render_pool = multiprocessing.Pool(render_workers)
+    try:
+        write_threads = start_threads(consume_stage, write_workers, write_queue, write_page)
+        ocr_threads = start_threads(consume_stage, ocr_workers, ocr_queue, ocr_page)
+        # already rendered pages are fed from their own thread so rendering starts right away instead of waiting
+        # for that backlog to fit into the bounded ocr queue
+        for thread in start_threads(render_stage, render_workers) + start_threads(feed_rendered_pages, 1):
+            thread.join()
+        for _ in ocr_threads:
+            ocr_queue.put(None)
+        for thread in ocr_threads:
+            thread.join()
+        for _ in write_threads:
+            write_queue.put(None)
+        for thread in write_threads:
+            thread.join()
+    finally:
+        render_pool.terminate()
+    if pipeline_errors:
+        error_type, error_value, error_traceback = pipeline_errors[0]
+        raise error_type, error_value, error_traceback
+    return dict(manifest.pages)
@@ -1,16 +1,29 @@
 import pickle
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
 import boto
 import pandas as pd
+import numpy as np
 import json
 import jsonschema
+from collections import OrderedDict
 from collections import defaultdict
-from copy import deepcopy
+from collections import namedtuple
+from functools import partial
+from itertools import imap
+from multiprocessing.pool import ThreadPool
 import boto.mturk.connection as tc
 import boto.mturk.question as tq
 from boto.mturk.qualification import PercentAssignmentsApprovedRequirement, Qualifications, Requirement
 import requests
 
 from annotation_schema import page_schema
+import instrumentation
+from instrumentation import instrumented
 
 """
 This module defines several functions used in the example mechanical-turk jupyter notebook.
@@ -75,6 +88,17 @@ def make_book_group_urls(book_groups, book_group, ranges):
     return group_urls
 
 
+def build_qualifications():
+    """
+    Creates a single qualification that workers have a > 95% acceptance rate.
+    :return: boto qualification obj.
+    """
+    qualifications = Qualifications()
+    req1 = PercentAssignmentsApprovedRequirement(comparator="GreaterThan", integer_value="95")
+    qualifications.add(req1)
+    return qualifications
+
+
 def build_hit_params(url, static_params):
     """
     Dynamically builds some HIT params that will change based on the book/url
@@ -82,60 +106,264 @@ def build_hit_params(url, static_params):
     :param static_params: Universal HIT params (set by user in notebook).
     :return: complete HIT parameters.
     """
-    def build_qualifications():
-        """
-        Creates a single qualification that workers have a > 95% acceptance rate.
-        :return: boto qualification obj.
-        """
-        qualifications = Qualifications()
-        req1 = PercentAssignmentsApprovedRequirement(comparator="GreaterThan", integer_value="95")
-        qualifications.add(req1)
-        return qualifications
-    
-    hit_params = deepcopy(static_params)
+    hit_params = dict(static_params)
     hit_params['qualifications'] = build_qualifications()
     hit_params['questionform'] = tq.ExternalQuestion(url, static_params['frame_height'])
     hit_params['reward'] = boto.mturk.price.Price(hit_params['amount'])
     return hit_params
 
 
+class HitTemplate(object):
+    """
+    create_hit arguments compiled once from the static HIT params. The qualifications and reward objects are built
+    a single time and shared by every HIT; only the ExternalQuestion is made per url.
+    :param static_params: Universal HIT params (set by user in notebook).
+    """
+    def __init__(self, static_params):
+        self.frame_height = static_params['frame_height']
+        self.create_hit_args = {
+            'title': static_params['title'],
+            'description': static_params['description'],
+            'keywords': static_params['keywords'],
+            'reward': boto.mturk.price.Price(static_params['amount']),
+            'max_assignments': static_params['max_assignments'],
+            'duration': static_params['duration'],
+            'qualifications': build_qualifications(),
+            'lifetime': static_params['lifetime']
+        }
+
+    def create_hit_kwargs(self, url):
+        """
+        :param url: formatted url of page image on s3
+        :return: keyword arguments for mturk_connection.create_hit
+        """
+        hit_args = dict(self.create_hit_args)
+        hit_args['question'] = tq.ExternalQuestion(url, self.frame_height)
+        return hit_args
+
+
+def compile_hit_template(static_hit_params):
+    """
+    :param static_hit_params: User-defined global HIT params, or an already compiled HitTemplate
+    :return: HitTemplate
+    """
+    if isinstance(static_hit_params, HitTemplate):
+        return static_hit_params
+    return HitTemplate(static_hit_params)
+
+
 def create_single_hit(mturk_connection, url, static_hit_params):
     """
     Creates a single HIT from a provided url
     :param mturk_connection: active mturk connection established by user in the nb.
     :param url: page url for the HIT
-    :param static_hit_params: User-defined global HIT params
+    :param static_hit_params: User-defined global HIT params, or a HitTemplate compiled from them
     :return: boto create hit return as a status check
     """
-    hit_params = build_hit_params(url, static_hit_params)
-    create_hit_result = mturk_connection.create_hit(
-        title=hit_params['title'],
-        description=hit_params['description'],
-        keywords=hit_params['keywords'],
-        question=hit_params['questionform'],
-        reward=hit_params['reward'],
-        max_assignments=hit_params['max_assignments'],
-        duration=hit_params['duration'],
-        qualifications=hit_params['qualifications'],
-        lifetime=hit_params['lifetime']
-    )
+    hit_template = compile_hit_template(static_hit_params)
+    create_hit_result = mturk_connection.create_hit(**hit_template.create_hit_kwargs(url))
     return create_hit_result
 
 
-def create_hits_from_pages(mturk_connection, page_links, static_hit_params):
-    for url in page_links:
-        create_single_hit(mturk_connection, url, static_hit_params)
-    
+class RateLimiter(object):
+    """
+    Spaces out calls shared across worker threads so that no more than max_rps start in any second.
+    """
+    def __init__(self, max_rps=None):
+        self.interval = 1.0 / max_rps if max_rps else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def is_throttling_error(request_error):
+    """
+    Checks whether an mturk request failed because of request throttling rather than a bad request.
+    :param request_error: boto MTurkRequestError
+    :return: True if the request should be retried
+    """
+    error_body = str(request_error.body)
+    return request_error.status == 503 or 'Throttl' in error_body or 'ServiceUnavailable' in error_body
+
+
+def call_with_retry(mturk_call, call_args, rate_limiter=None, max_retries=5, backoff=1.0):
+    """
+    Makes an mturk call, retrying with exponential backoff while the service is throttling requests.
+    :param mturk_call: function making the request
+    :param call_args: tuple of positional arguments for mturk_call
+    :param rate_limiter: optional RateLimiter shared by concurrent callers
+    :param max_retries: number of retries before the throttling error is raised
+    :param backoff: seconds to wait before the first retry, doubled on every further retry
+    :return: mturk_call's return value
+    """
+    attempt = 0
+    while True:
+        if rate_limiter:
+            rate_limiter.wait()
+        try:
+            return mturk_call(*call_args)
+        except tc.MTurkRequestError as e:
+            if attempt >= max_retries or not is_throttling_error(e):
+                raise
+            time.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+            attempt += 1
+
+
+def read_journal(journal_path):
+    """
+    Reads the records of a json-lines journal. A partially written final line, left by a crash, is ignored.
+    :param journal_path: path to the journal file
+    :return: list of record dicts
+    """
+    records = []
+    if not journal_path or not os.path.isfile(journal_path):
+        return records
+    with open(journal_path, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+    return records
+
+
+def open_journal(journal_path):
+    """
+    Opens a json-lines journal for appending. A partially written final line left by a crash is truncated first,
+    so the next record doesn't get appended to the fragment.
+    :param journal_path: path to the journal file
+    :return: file opened for appending
+    """
+    if os.path.isfile(journal_path):
+        with open(journal_path, 'r+b') as f:
+            journal_data = f.read()
+            if journal_data and not journal_data.endswith('\n'):
+                f.truncate(journal_data.rfind('\n') + 1)
+    return open(journal_path, 'a')
+
+
+def append_journal(journal_file, record):
+    """
+    Appends a record to an open json-lines journal and flushes it to disk.
+    :param journal_file: journal opened for appending
+    :param record: json serializable dict
+    """
+    journal_file.write(json.dumps(record) + '\n')
+    journal_file.flush()
+    os.fsync(journal_file.fileno())
+
 
-def delete_all_hits(mturk_connection):
+@instrumented('create_hits_from_pages')
+def create_hits_from_pages(mturk_connection, page_links, static_hit_params, workers=1, max_rps=None,
+                           journal_path=None, max_retries=5):
+    """
+    Creates a HIT for every page url, optionally from a pool of worker threads.
+    :param mturk_connection: active mturk connection established by user in the nb.
+    :param page_links: page urls to create HITs for
+    :param static_hit_params: User-defined global HIT params
+    :param workers: number of concurrent create_hit requests
+    :param max_rps: maximum create_hit requests per second across all workers
+    :param journal_path: json-lines file recording url:HITId for every created HIT. Urls already in the journal
+    are skipped, so re-running after a crash only posts the pages that are missing.
+    :param max_retries: retries per url while mturk is throttling requests
+    :return: url:HITId dict of all posted pages (including earlier runs) and a url:error dict of failures
+    """
+    created_hits = {record['url']: record['hit_id'] for record in read_journal(journal_path)}
+    urls_to_post = [url for url in OrderedDict.fromkeys(page_links) if url not in created_hits]
+    failed_urls = {}
+    rate_limiter = RateLimiter(max_rps)
+    hit_template = compile_hit_template(static_hit_params)
+
+    def post_page(url):
+        try:
+            create_hit_result = call_with_retry(create_single_hit, (mturk_connection, url, hit_template),
+                                                rate_limiter, max_retries)
+            return url, create_hit_result[0].HITId, None
+        except Exception as e:
+            return url, None, repr(e)
+
+    journal_file = open_journal(journal_path) if journal_path else None
+    pool = ThreadPool(workers)
+    try:
+        for url, hit_id, error in pool.imap_unordered(post_page, urls_to_post):
+            if error:
+                failed_urls[url] = error
+                continue
+            created_hits[url] = hit_id
+            if journal_file:
+                append_journal(journal_file, {'url': url, 'hit_id': hit_id})
+    finally:
+        pool.terminate()
+        if journal_file:
+            journal_file.close()
+    if failed_urls:
+        print(str(len(failed_urls)) + ' pages could not be posted')
+    return created_hits, failed_urls
+
+
+def execute_review_actions(action, ids, perform_action, workers=1, max_rps=None, log_path=None, max_retries=5):
+    """
+    Runs a single review action (approve, reject, block, disable) over a batch of ids.
+    :param action: action name recorded in the log, e.g. 'approve'
+    :param ids: assignment, worker or HIT ids to act on
+    :param perform_action: function of one id that makes the mturk call
+    :param workers: number of concurrent requests
+    :param max_rps: maximum requests per second across all workers
+    :param log_path: json-lines log of every action's outcome. Ids the log records as done for this action are
+    skipped, so an interrupted batch can be re-run.
+    :param max_retries: retries per id while mturk is throttling requests
+    :return: dict of 'done' and 'skipped' counts and an id:error dict of 'failed' ids
+    """
+    already_done = {record['id'] for record in read_journal(log_path)
+                    if record['action'] == action and record['status'] == 'done'}
+    ids_to_process = [id_ for id_ in OrderedDict.fromkeys(ids) if id_ not in already_done]
+    summary = {'done': 0, 'skipped': len(already_done.intersection(ids)), 'failed': {}}
+    rate_limiter = RateLimiter(max_rps)
+
+    def perform(id_):
+        try:
+            call_with_retry(perform_action, (id_,), rate_limiter, max_retries)
+            return id_, None
+        except Exception as e:
+            return id_, repr(e)
+
+    log_file = open_journal(log_path) if log_path else None
+    pool = ThreadPool(workers)
+    try:
+        for id_, error in pool.imap_unordered(perform, ids_to_process):
+            if error:
+                summary['failed'][id_] = error
+            else:
+                summary['done'] += 1
+            if log_file:
+                append_journal(log_file, {'action': action, 'id': id_, 'status': 'failed' if error else 'done',
+                                          'error': error})
+    finally:
+        pool.terminate()
+        if log_file:
+            log_file.close()
+    return summary
+
+
+def delete_all_hits(mturk_connection, workers=1, log_path=None):
     """
     Permanently disables/ deletes all of the users active HITs.
     :param mturk_connection: active mturk connection established by user in the nb.
-    :return:
+    :param workers: number of concurrent requests
+    :param log_path: optional action log, see execute_review_actions
+    :return: execute_review_actions summary
     """
-    my_hits = list(mturk_connection.get_all_hits())
-    for hit in my_hits:
-        mturk_connection.disable_hit(hit.HITId)
+    my_hits = [hit.HITId for hit in mturk_connection.get_all_hits()]
+    return execute_review_actions('disable', my_hits, mturk_connection.disable_hit, workers, log_path=log_path)
 
 
 def count_pages_in_df(any_result_df):
@@ -146,9 +374,26 @@ def count_pages_with_cat(consensus_df, category):
     return len(pd.unique(consensus_df[consensus_df['category'] == category]['page']))
 
 
-def delete_some_hits(mturk_connection, hit_ids):
-    for hit in hit_ids.keys():
-        mturk_connection.disable_hit(hit)
+def delete_some_hits(mturk_connection, hit_ids, workers=1, log_path=None):
+    return execute_review_actions('disable', hit_ids.keys(), mturk_connection.disable_hit, workers, log_path=log_path)
+
+
+def iter_reviewable_hit_pages(mturk_connection, rate_limiter=None, max_retries=5):
+    """
+    Pages through the user's reviewable HITs, 100 at a time.
+    :param mturk_connection: active mturk connection established by user in the nb.
+    :param rate_limiter: optional RateLimiter shared with other requests
+    :param max_retries: retries per page while mturk is throttling requests
+    :return: generator of lists of boto HIT result objects
+    """
+    page_n = 1
+    while True:
+        list_page = partial(mturk_connection.get_reviewable_hits, page_size=100, page_number=page_n)
+        hit_range = call_with_retry(list_page, (), rate_limiter, max_retries)
+        if not hit_range:
+            break
+        yield hit_range
+        page_n += 1
 
 
 def get_completed_hits(mturk_connection):
@@ -158,18 +403,12 @@ def get_completed_hits(mturk_connection):
     :return: list of boto HIT result objects
     """
     reviewable_hits = []
-    page_n = 1
-    hits_left = True
-    while hits_left:
-        hit_range = mturk_connection.get_reviewable_hits(page_size=100, page_number=page_n)
-        if not hit_range:
-            hits_left = False
-            break
+    for hit_range in iter_reviewable_hit_pages(mturk_connection):
         reviewable_hits.extend(hit_range)
-        page_n += 1
     return reviewable_hits
 
 
+@instrumented('get_assignments')
 def get_assignments(mturk_connection, reviewable_hits, status=None):
     """
     Retrieves individual assignments associated with the specified HITs.
@@ -185,6 +424,38 @@ def get_assignments(mturk_connection, reviewable_hits, status=None):
     return assignments
 
 
+def harvest_assignments(mturk_connection, status=None, workers=8, max_rps=None, max_retries=5, hit_filter=None):
+    """
+    Combines get_completed_hits and get_assignments into one pipelined harvest. Assignment requests for the HITs on
+    a page are handed to a pool of worker threads as soon as the page is listed, so they run while later pages of
+    reviewable HITs are still being fetched.
+    :param mturk_connection: active mturk connection established by user in the nb.
+    :param status: HIT status to filter by.
+    :param workers: number of concurrent get_assignments requests
+    :param max_rps: maximum requests per second across listing and assignment calls
+    :param max_retries: retries per call while mturk is throttling requests
+    :param hit_filter: optional function of a HITId. Assignments are only fetched for HITs it returns True for.
+    :return: hit_id:assignment dict, as returned by get_assignments
+    """
+    rate_limiter = RateLimiter(max_rps)
+    fetch_assignments = partial(mturk_connection.get_assignments, status=status)
+    pending_requests = []
+    pool = ThreadPool(workers)
+    try:
+        for hit_range in iter_reviewable_hit_pages(mturk_connection, rate_limiter, max_retries):
+            for hit in hit_range:
+                if hit_filter and not hit_filter(hit.HITId):
+                    continue
+                request = pool.apply_async(call_with_retry, (fetch_assignments, (hit.HITId,), rate_limiter, max_retries))
+                pending_requests.append((hit.HITId, request))
+        assignments = defaultdict(list)
+        for hit_id, request in pending_requests:
+            assignments[hit_id].extend(request.get())
+    finally:
+        pool.terminate()
+    return assignments
+
+
 def process_raw_hits(assignments_by_hit):
     """
     Extracts assignment results from boto assignment objects in a more convienent form.
@@ -194,24 +465,71 @@ def process_raw_hits(assignments_by_hit):
     mechanical_turk_results = defaultdict(list)
     for hit_id, hit_assignments in assignments_by_hit.items():
         for assignment in hit_assignments:
-            for answers in assignment.answers:
-                box_result = answers[1].fields[0]
-                box_json = json.loads(box_result)
-                for box in box_json:
-                    box['worker_id'] = assignment.WorkerId
-                mechanical_turk_results[hit_id].append({
-                    assignment.AssignmentId: {answers[0].fields[0]: box_json}}
-                )
+            for page, box_json in parse_assignment_answers(assignment):
+                mechanical_turk_results[hit_id].append({assignment.AssignmentId: {page: box_json}})
     return mechanical_turk_results
 
 
-def accept_hits(mturk_connection, assignments_to_approve):
+def parse_assignment_answers(assignment):
+    """
+    Parses the labeled boxes out of each page answered in an assignment.
+    :param assignment: boto assignment object
+    :return: list of (page, boxes) tuples, with the worker id added to every box
+    """
+    parsed_answers = []
+    for answers in assignment.answers:
+        box_result = answers[1].fields[0]
+        box_json = json.loads(box_result)
+        for box in box_json:
+            box['worker_id'] = assignment.WorkerId
+        parsed_answers.append((answers[0].fields[0], box_json))
+    return parsed_answers
+
+
+BoxRecord = namedtuple('BoxRecord', ['hit_id', 'assignment_id', 'worker_id', 'page', 'box_id', 'category',
+                                     'group_n'])
+
+
+def iter_box_records(assignments_by_hit):
+    """
+    Streams one flat record per labeled box as assignment answers are parsed, instead of building the nested
+    process_raw_hits structure.
+    :param assignments_by_hit: hit_id:assignment dict, as returned by get_assignments
+    :return: generator of BoxRecords
+    """
+    for hit_id, hit_assignments in assignments_by_hit.items():
+        for assignment in hit_assignments:
+            for page, box_json in parse_assignment_answers(assignment):
+                for box in box_json:
+                    yield BoxRecord(hit_id, assignment.AssignmentId, assignment.WorkerId, page, box['id'],
+                                    box['category'], box.get('group_n', 0))
+
+
+def iter_raw_hit_box_records(raw_hit_results):
+    """
+    Streams box records out of results already processed with process_raw_hits.
+    :param raw_hit_results: results dict processed using the process_raw_hits function above
+    :return: generator of BoxRecords
+    """
+    for hit_id, assignments in raw_hit_results.items():
+        for assignment in assignments:
+            for a_id, annotation in assignment.items():
+                for page, labeled_text in annotation.items():
+                    for box in labeled_text:
+                        yield BoxRecord(hit_id, a_id, box['worker_id'], page, box['id'], box['category'],
+                                        box.get('group_n', 0))
+
+
+def accept_hits(mturk_connection, assignments_to_approve, workers=1, log_path=None):
+    submitted_assignments = []
     for hit_id, hit_assignments in assignments_to_approve.items():
         for assignment in hit_assignments:
             if assignment.AssignmentStatus == 'Submitted':
-                mturk_connection.approve_assignment(assignment.AssignmentId)
+                submitted_assignments.append(assignment.AssignmentId)
             else:
                 print assignment.AssignmentStatus
+    return execute_review_actions('approve', submitted_assignments, mturk_connection.approve_assignment, workers,
+                                  log_path=log_path)
 
 
 def match_workers_assignments(worker_list, worker_result_df):
@@ -225,29 +543,34 @@ def match_workers_assignments(worker_list, worker_result_df):
     return pd.unique(match_df['assignment_id']).tolist(), pd.unique(match_df['worker_id']).tolist()
 
 
-def reject_assignments(mturk_connection, workers_to_reject, worker_result_df):
+def reject_assignments(mturk_connection, workers_to_reject, worker_result_df, workers=1, log_path=None):
     feedback_message = """
     Your HITs contained many incomplete or incorrect pages.
     """
     assignments_to_reject, workers_rejected = match_workers_assignments(workers_to_reject, worker_result_df)
     reject_count = len(assignments_to_reject)
     worker_count = len(workers_rejected)
-    for assignment_id in assignments_to_reject:
-        try:
-            mturk_connection.reject_assignment(assignment_id, feedback_message)
-        except boto.mturk.connection.MTurkRequestError:
+    reject = partial(mturk_connection.reject_assignment, feedback=feedback_message)
+    summary = execute_review_actions('reject', assignments_to_reject, reject, workers, log_path=log_path)
+    for assignment_id, error in summary['failed'].items():
+        if 'InvalidAssignmentState' in error:
             print 'assignment ' + str(assignment_id) + ' already accepted or rejected'
+        else:
+            print 'failed to reject assignment ' + str(assignment_id) + ': ' + error
 
     return reject_count, worker_count
 
 
-def ban_bad_workers(mturk_connection, worker_ids):
-    for worker in worker_ids:
-        reason_for_block = """
-        Worker's submissions were largely incomplete.
-        """
-        print 'blocking ' + str(worker)
+def ban_bad_workers(mturk_connection, worker_ids, workers=1, log_path=None):
+    reason_for_block = """
+    Worker's submissions were largely incomplete.
+    """
+
+    def block(worker):
         mturk_connection.block_worker(worker, reason_for_block)
+        print 'blocked ' + str(worker)
+
+    return execute_review_actions('block', worker_ids, block, workers, log_path=log_path)
 
 
 def get_assignment_statuses(assignment_results):
@@ -259,46 +582,156 @@ def get_assignment_statuses(assignment_results):
     return status_series.value_counts()
 
 
+results_col_names = ['page', 'category', 'hit_id', 'assignment_id', 'box_id', 'worker_id']
+shining_results_col_names = ['page', 'category', 'hit_id', 'assignment_id', 'id', 'worker_id', 'group_n']
+
+
+def iter_result_rows(raw_hit_results, with_group_n=False):
+    """
+    Flattens processed HIT results into one row per labeled box.
+    :param raw_hit_results: results dict processed using the process_raw_hits function above
+    :param with_group_n: append the box's question group (as a string) to each row
+    :return: generator of row lists ordered like results_col_names (or shining_results_col_names)
+    """
+    return iter_record_rows(iter_raw_hit_box_records(raw_hit_results), with_group_n)
+
+
+def iter_record_rows(box_records, with_group_n=False):
+    """
+    Orders box records into results dataframe rows.
+    :param box_records: iterable of BoxRecords
+    :param with_group_n: append the box's question group (as a string) to each row
+    :return: generator of row lists ordered like results_col_names (or shining_results_col_names)
+    """
+    for record in box_records:
+        row = [record.page, record.category, record.hit_id, record.assignment_id, record.box_id, record.worker_id]
+        if with_group_n:
+            row.append(str(record.group_n))
+        yield row
+
+
+def build_results_df(rows, col_names):
+    """
+    Builds a results dataframe in one shot by filling a buffer per column and handing them to pandas together.
+    :param rows: iterable of row lists ordered like col_names
+    :param col_names: dataframe columns
+    :return: results dataframe
+    """
+    column_buffers = [[] for _ in col_names]
+    appenders = [column.append for column in column_buffers]
+    for row in rows:
+        for append, value in zip(appenders, row):
+            append(value)
+    columns = OrderedDict((name, np.array(column, dtype=object)) for name, column in zip(col_names, column_buffers))
+    return pd.DataFrame(columns, columns=col_names)
+
+
+@instrumented('make_results_df')
 def make_results_df(raw_hit_results):
     """
     Creates a pandas dataframe from processed HIT results.
-    NOTE- the way I do this with pandas is not efficient, despite setting the new rows by loc.
-    Profiling this function pointed a finger at pandas, but I need to investigate further.
     :param raw_hit_results:  results dict processed using the process_raw_hits function above
     :return: text-box level results in a pandas dataframe
     """
-    col_names = ['page', 'category', 'hit_id', 'assignment_id', 'box_id', 'worker_id']
-    results_df = pd.DataFrame(columns=col_names)
-    for hit_id, assignments in raw_hit_results.items():
-        for assignment in assignments:
-            for a_id, annotation in assignment.items():
-                for page, labeled_text in annotation.items():
-                    for box in labeled_text:
-                        results_df.loc[len(results_df)] = \
-                            [page, box['category'], hit_id, a_id, box['id'], box['worker_id']]
-    return results_df
+    return build_results_df(iter_result_rows(raw_hit_results), results_col_names)
+
+
+def make_results_df_from_records(box_records, with_group_n=False):
+    """
+    Builds a results dataframe straight from streamed box records, e.g. iter_box_records(get_assignments(...)),
+    without materializing the nested process_raw_hits results.
+    :param box_records: iterable of BoxRecords
+    :param with_group_n: build the shining results layout (make_shining_results_df) instead of make_results_df's
+    :return: text-box level results in a pandas dataframe
+    """
+    col_names = shining_results_col_names if with_group_n else results_col_names
+    return build_results_df(iter_record_rows(box_records, with_group_n), col_names)
 
 
 def make_shining_results_df(raw_hit_results):
     """
     similar to above with a new column for question group
     """
-    col_names = ['page', 'category', 'hit_id', 'assignment_id', 'id', 'worker_id', 'group_n']
+    return build_results_df(iter_result_rows(raw_hit_results, with_group_n=True), shining_results_col_names)
+
+
+def make_results_df_by_row(raw_hit_results, with_group_n=False):
+    """
+    The original row-at-a-time dataframe construction. This is quadratic in the number of boxes and is only kept
+    as a reference for check_results_df.
+    :param raw_hit_results: results dict processed using the process_raw_hits function above
+    :param with_group_n: build the shining results layout
+    :return: results dataframe
+    """
+    col_names = shining_results_col_names if with_group_n else results_col_names
     results_df = pd.DataFrame(columns=col_names)
-    for hit_id, assignments in raw_hit_results.items():
-        for assignment in assignments:
-            for a_id, annotation in assignment.items():
-                for page, labeled_text in annotation.items():
-                    for box in labeled_text:
-                        if 'group_n' in box.keys():
-                            group_n = box['group_n']
-                        else:
-                            group_n = 0
-                        results_df.loc[len(results_df)] = \
-                            [page, box['category'], hit_id, a_id, box['id'], box['worker_id'], str(group_n)]
+    for row in iter_result_rows(raw_hit_results, with_group_n):
+        results_df.loc[len(results_df)] = row
     return results_df
 
 
+def check_results_df(raw_hit_results, with_group_n=False):
+    """
+    Verifies that the columnar builder matches the row-at-a-time construction on the same input.
+    :param raw_hit_results: results dict processed using the process_raw_hits function above
+    :param with_group_n: check make_shining_results_df instead of make_results_df
+    :return: True if the frames match, raises AssertionError otherwise
+    """
+    if with_group_n:
+        built_df = make_shining_results_df(raw_hit_results)
+    else:
+        built_df = make_results_df(raw_hit_results)
+    reference_df = make_results_df_by_row(raw_hit_results, with_group_n)
+    pd.util.testing.assert_frame_equal(built_df, reference_df, check_dtype=False, check_index_type=False)
+    return True
+
+
+def compute_box_consensus(results_df, no_consensus_flag):
+    """
+    Counts category votes for every (page, box_id) with array operations instead of a per-group mode.
+    Categories and boxes are mapped to integer codes, votes are tallied with a single bincount, and the winner, its
+    vote count, the agreement ratio and a tie flag are read off the vote matrix.
+    :param results_df: result dataframe generated by make_results_df.
+    :param no_consensus_flag: category to record for boxes where the top categories are tied.
+    :return: one row per box with page, box_id, category, hit_id, vote_count, agreement and tie columns
+    """
+    consensus_col_names = ['page', 'box_id', 'category', 'hit_id', 'vote_count', 'agreement', 'tie']
+    labeled_df = results_df[results_df['category'].notnull()]
+    if labeled_df.empty:
+        return pd.DataFrame(columns=consensus_col_names)
+    page_codes, pages = pd.factorize(labeled_df['page'])
+    box_id_codes, box_ids = pd.factorize(labeled_df['box_id'])
+    box_codes, box_keys = pd.factorize(page_codes.astype(np.int64) * len(box_ids) + box_id_codes)
+    category_codes, categories = pd.factorize(labeled_df['category'])
+
+    n_boxes = len(box_keys)
+    n_categories = len(categories)
+    votes = np.bincount(box_codes * n_categories + category_codes, minlength=n_boxes * n_categories)
+    votes = votes.reshape(n_boxes, n_categories)
+
+    winners = votes.argmax(axis=1)
+    vote_count = votes.max(axis=1)
+    tie = (votes == vote_count[:, np.newaxis]).sum(axis=1) > 1
+    total_votes = votes.sum(axis=1)
+
+    category = np.asarray(categories, dtype=object)[winners]
+    category[tie] = no_consensus_flag
+    _, first_rows = np.unique(box_codes, return_index=True)
+
+    consensus_results_df = pd.DataFrame(OrderedDict(zip(consensus_col_names, [
+        np.asarray(pages, dtype=object)[box_keys // len(box_ids)],
+        np.asarray(box_ids, dtype=object)[box_keys % len(box_ids)],
+        category,
+        labeled_df['hit_id'].values[first_rows],
+        vote_count,
+        vote_count / total_votes.astype(float),
+        tie
+    ])))
+    consensus_results_df.sort_values(['page', 'box_id'], inplace=True)
+    return consensus_results_df.reset_index(drop=True)
+
+
+@instrumented('make_consensus_df')
 def make_consensus_df(results_df, no_consensus_flag):
     """
     Computes consensus labels from turker responses.
@@ -306,13 +739,7 @@ def make_consensus_df(results_df, no_consensus_flag):
     :param no_consensus_flag: value to fill in for boxes without consensus.
     :return: consensus results
     """
-    grouped_by_page = results_df.groupby(['page', 'box_id'])
-    aggregated_df = grouped_by_page.agg(pd.DataFrame.mode)
-    aggregated_df.drop(['assignment_id', 'page', 'box_id', 'worker_id'], axis=1, inplace=True)
-    aggregated_df = aggregated_df.fillna(no_consensus_flag)
-    consensus_results_df = aggregated_df.reset_index()
-    consensus_results_df.drop('level_2', axis=1, inplace=True)
-    return consensus_results_df
+    return compute_box_consensus(results_df, no_consensus_flag)
 
 
 def make_consensus_df_w_worker_id(combined_results_df, combined_consensus_results_df):
@@ -322,14 +749,17 @@ def make_consensus_df_w_worker_id(combined_results_df, combined_consensus_result
     :param combined_consensus_results_df: consensus results dataframe.
     :return:
     """
-    consensus_with_worker_id_df = pd.DataFrame(columns=list(combined_consensus_results_df.columns) + ['worker_id', 'consensus_category'])
-    for hitbox_id, rows in combined_results_df.groupby(['hit_id', 'box_id']):
-        this_consensus_row = combined_consensus_results_df[
-            (combined_consensus_results_df['hit_id'] == hitbox_id[0]) & (combined_consensus_results_df['box_id'] == hitbox_id[1])]
-        new_rows = rows.copy()
-        new_rows['consensus_category'] = this_consensus_row['category'].values[0]
-        consensus_with_worker_id_df = consensus_with_worker_id_df.append(new_rows)
-    return consensus_with_worker_id_df
+    key_cols = ['hit_id', 'box_id']
+    consensus_only_cols = [col for col in combined_consensus_results_df.columns
+                           if col not in combined_results_df.columns]
+    box_consensus_df = combined_consensus_results_df[key_cols + ['category'] + consensus_only_cols]
+    box_consensus_df = box_consensus_df.drop_duplicates(key_cols).rename(columns={'category': 'consensus_category'})
+
+    consensus_with_worker_id_df = combined_results_df.merge(box_consensus_df, how='left', on=key_cols)
+    consensus_with_worker_id_df.index = combined_results_df.index
+    consensus_with_worker_id_df.sort_values(key_cols, kind='mergesort', inplace=True)
+    # DataFrame.append used to sort the unaligned columns, so keep that ordering.
+    return consensus_with_worker_id_df[sorted(consensus_with_worker_id_df.columns)]
 
 
 def form_annotation_url(page_name, anno_dir):
@@ -352,7 +782,7 @@ def load_local_annotation(page_name, anno_dir):
     base_path = '/Users/schwenk/wrk/notebooks/stb/ai2-vision-turk-data/textbook-annotation-test/'
     file_path = base_path + anno_dir + page_name.replace('jpeg', 'json')
     try:
-        with open(file_path, '/r') as f:
+        with open(file_path, 'r') as f:
             local_annotations = json.load(f)
     except IOError as e:
         print e
@@ -360,6 +790,58 @@ def load_local_annotation(page_name, anno_dir):
     return local_annotations
 
 
+question_cats = ['Multiple Choice',
+                 'Fill-in-the-Blank',
+                 'Short Answer',
+                 'Discussion']
+
+
+def apply_consensus_updates(unannotated_page, box_updates):
+    """
+    Writes consensus categories into a page annotation, moving text boxes labeled as questions to the question
+    section.
+    :param unannotated_page: original annotation json
+    :param box_updates: iterable of (box_id, category) pairs
+    :return: the updated annotation
+    """
+    # group_n = result_row['group_n'] # this change is for the simpler question annotation task
+    group_n = 0
+    for box_id, category in box_updates:
+        if box_id[0] == 'Q':
+            question_box = unannotated_page['question'][box_id]
+            question_box['category'] = category
+            question_box['group_n'] = group_n
+        elif category in question_cats:
+            new_id = box_id.replace('T', 'Q')
+            question_box = unannotated_page['text'].pop(box_id)
+            question_box['category'] = category
+            question_box['group_n'] = group_n
+            question_box['box_id'] = new_id
+            unannotated_page.setdefault('question', {})[new_id] = question_box
+    return unannotated_page
+
+
+def write_json_atomically(file_path, json_data):
+    """
+    Writes json to a temp file next to file_path and renames it into place, so readers never see a partial file.
+    :param file_path: destination path
+    :param json_data: json serializable object
+    """
+    dest_dir = os.path.dirname(file_path) or '.'
+    fd, temp_path = tempfile.mkstemp(dir=dest_dir, prefix='.' + os.path.basename(file_path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(json_data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, file_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
 def process_annotation_results(anno_page_name, boxes, unannotated_page, annotations_folder, page_schema):
     """
     read local annotations on disk and creates new annotation with consensus turk results
@@ -369,34 +851,9 @@ def process_annotation_results(anno_page_name, boxes, unannotated_page, annotati
     :param annotations_folder: destination dir to be written to
     :param page_schema: page schema to validate against.
     """
-    question_cats = ['Multiple Choice',
-                     'Fill-in-the-Blank',
-                     'Short Answer',
-                     'Discussion']
-
-    def update_box(result_row):
-        box_id = result_row['box_id']
-        category = result_row['category']
-        # group_n = result_row['group_n'] # this change is for the simpler question annotation task
-        group_n = 0
-        if box_id[0] == 'Q':
-            annotation_type = 'question'
-            unannotated_page[annotation_type][box_id]['category'] = category
-            unannotated_page[annotation_type][box_id]['group_n'] = group_n
-        elif category in question_cats:
-            old_annotation_type = 'text'
-            new_annotation_type = 'question'
-            new_id = box_id.replace('T', 'Q')
-            unannotated_page[new_annotation_type][new_id] = unannotated_page[old_annotation_type][box_id]
-            unannotated_page[new_annotation_type][new_id]['category'] = category
-            unannotated_page[new_annotation_type][new_id]['group_n'] = group_n
-            unannotated_page[new_annotation_type][new_id]['box_id'] = new_id
-            del unannotated_page[old_annotation_type][box_id]
-            unannotated_page[annotation_type][box_id.replace('Q', 'T')]['group_n'] = group_n
-    boxes.apply(update_box, axis=1)
+    apply_consensus_updates(unannotated_page, zip(boxes['box_id'].values, boxes['category'].values))
     file_path = annotations_folder + anno_page_name.replace('jpeg', 'json').replace("\\", "")
-    with open(file_path, 'wb') as f:
-        json.dump(unannotated_page, f)
+    write_json_atomically(file_path, unannotated_page)
     return
 
 
@@ -409,17 +866,58 @@ def write_consensus_results(page_name, boxes, local_result_path, anno_dir):
         process_annotation_results(page_name, boxes, unaltered_annotations, local_result_path, page_schema)
 
 
-def write_results_df(aggregate_results_df, anno_dir, local_result_dir='newly-labeled-annotations/'):
+def write_page_consensus(page_job):
+    """
+    Process pool task for write_results_df: loads one page's annotation, applies its box updates and writes it.
+    :param page_job: (page, box_updates, annotation path, result path) tuple
+    :return: page and None on success, or page and the error message
+    """
+    page, box_updates, annotation_path, result_path = page_job
+    try:
+        with open(annotation_path, 'r') as f:
+            unannotated_page = json.load(f)
+        write_json_atomically(result_path, apply_consensus_updates(unannotated_page, box_updates))
+        return page, None
+    except Exception as e:
+        return page, repr(e)
+
+
+@instrumented('write_results_df')
+def write_results_df(aggregate_results_df, anno_dir, local_result_dir='newly-labeled-annotations/', workers=None):
     """
     writes new annotation json to disk from a results dataframe
     :param aggregate_results_df: dataframe to write
     :param anno_dir: destination dir
     :param local_result_dir: local original annotations to add to
+    :param workers: size of the process pool pages are written from, defaults to the number of cores
+    :return: page:error dict, with None for pages written successfully
     """
     base_path = '/Users/schwenk/wrk/notebooks/stb/ai2-vision-turk-data/textbook-annotation-test/'    
     local_result_path = base_path + local_result_dir
-    for page, boxes in aggregate_results_df.groupby('page'):
-        write_consensus_results(page, boxes, local_result_path, anno_dir)
+    updates_by_page = OrderedDict()
+    for page, box_id, category in zip(aggregate_results_df['page'].values, aggregate_results_df['box_id'].values,
+                                      aggregate_results_df['category'].values):
+        updates_by_page.setdefault(page, []).append((box_id, category))
+    page_jobs = [(page, box_updates,
+                  base_path + anno_dir + page.replace('jpeg', 'json'),
+                  local_result_path + page.replace('jpeg', 'json').replace("\\", ""))
+                 for page, box_updates in updates_by_page.items()]
+
+    if workers == 1:
+        page_report = dict(imap(write_page_consensus, page_jobs))
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            page_report = dict(pool.imap_unordered(write_page_consensus, page_jobs, chunksize=16))
+        finally:
+            pool.terminate()
+    instrumentation.record_report_errors('write_results_df', page_report)
+    if instrumentation.metrics_enabled:
+        written_jobs = [page_job for page_job in page_jobs if not page_report[page_job[0]]]
+        instrumentation.record_bytes('write_results_df',
+                                     sum(instrumentation.file_size(page_job[2]) for page_job in written_jobs),
+                                     sum(instrumentation.file_size(page_job[3]) for page_job in written_jobs))
+    return page_report
 
 
 def review_results(pages_to_review, annotation_dir='newly-labeled-annotations/'):
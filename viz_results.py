@@ -2,14 +2,30 @@ import numpy as np
 import cv2
 import json
 import glob
+import hashlib
 import os
 import argparse
+import multiprocessing
 import PIL.Image as Image
 from collections import defaultdict
+from collections import namedtuple
+from itertools import groupby
+from itertools import imap
+
+import instrumentation
+from instrumentation import instrumented
 
 rect_types = ['text', 'arrowHeads']
 poly_types = ['blobs', 'arrows', 'backgroundBlobs']
 
+# image_format is 'png', 'jpeg' or 'webp'; quality applies to jpeg and webp, png_compression (0-9, None for the
+# opencv default) to png. contact_sheet tiles all relationships of an image into one image of tile_width wide tiles.
+RenderSettings = namedtuple('RenderSettings', ['image_format', 'quality', 'png_compression', 'contact_sheet',
+                                               'tile_width'])
+default_render_settings = RenderSettings('png', 90, None, False, 320)
+
+image_extensions = {'png': '.png', 'jpeg': '.jpeg', 'webp': '.webp'}
+
 
 def load_local_annotation(image_name, annotation_dir):
     file_path = annotation_dir + image_name + '.json'
@@ -35,25 +51,43 @@ def random_color():
     return random.randint(0,255), random.randint(0,255), random.randint(0,255)
 
 
+category_hex_colors = {
+    "unlabeled": "#8c9296",
+    "intraObjectLinkage": "#e7d323",
+    "intraObjectTextLinkage": "#e7d323",
+    "intraObjectLabel": "#286a8e",
+    "interObjectLinkage": "#3fb62c",
+    "intraObjectLoop": "#BA70CC",
+    "arrowDescriptor": "#e77423",
+    'intraObjectRegionLabel': "#696100",
+    'sectionTitle': "#ff00ff",
+    'imageTitle': "#8256AD",
+    'imageCaption': "#ff3300",
+    'textMisc': "#cccc00",
+    'misc': "#cccc00"
+}
+# BGR, thanks opencv!
+category_colors = {category: hex_to_rgb(hex_color)[::-1] for category, hex_color in category_hex_colors.items()}
+
+
 def get_category_color(category):
-    color_map = {
-        "unlabeled": "#8c9296",
-        "intraObjectLinkage": "#e7d323",
-        "intraObjectTextLinkage": "#e7d323",
-        "intraObjectLabel": "#286a8e",
-        "interObjectLinkage": "#3fb62c",
-        "intraObjectLoop": "#BA70CC",
-        "arrowDescriptor": "#e77423",
-        'intraObjectRegionLabel': "#696100",
-        'sectionTitle': "#ff00ff",
-        'imageTitle': "#8256AD",
-        'imageCaption': "#ff3300",
-        'textMisc': "#cccc00",
-        'misc': "#cccc00"
-    }
-    rgb_color = hex_to_rgb(color_map[category])
-    rgb_flipped = rgb_color[::-1]       # Thanks opencv!
-    return rgb_flipped
+    return category_colors[category]
+
+
+# drawable shape of a constituent, converted once per image: corners is the ((x, y), (x, y)) rectangle of rect types,
+# points the int32 polygon array of poly types, and bounds the (x_min, y_min, x_max, y_max) box around either
+ConstituentGeometry = namedtuple('ConstituentGeometry', ['corners', 'points', 'bounds'])
+
+
+def make_constituent_geometry(constituent):
+    if constituent['type'] in rect_types:
+        ul, lr = constituent['rectangle']
+        return ConstituentGeometry((tuple(ul), tuple(lr)), None,
+                                   (min(ul[0], lr[0]), min(ul[1], lr[1]), max(ul[0], lr[0]), max(ul[1], lr[1])))
+    if constituent['type'] in poly_types:
+        points = np.int32(constituent['polygon']).reshape(-1, 2)
+        return ConstituentGeometry(None, points, tuple(points.min(axis=0)) + tuple(points.max(axis=0)))
+    return None
 
 
 def build_relationships_to_draw(image_annotations):
@@ -68,60 +102,182 @@ def build_relationships_to_draw(image_annotations):
         return flattened_const_dict
     
     flattened_constituent_dict = flatten_constituent_dict(image_annotations)
+    constituent_geometry = {}
     relationships_with_props = {}
     for rel_id, relationship in image_annotations['relationships'].items():
         involved_const_ids = rel_id.split('+')
         rel_category = relationship['category']
         involved_const = {k: flattened_constituent_dict[k] for k in involved_const_ids}
+        for k, constituent in involved_const.items():
+            if k not in constituent_geometry:
+                constituent_geometry[k] = make_constituent_geometry(constituent)
         relationships_with_props[rel_id] = {
             "rel_id": rel_id,
             "category": rel_category,
-            "constituents": involved_const
+            "constituents": involved_const,
+            "geometry": [(k, constituent_geometry[k]) for k in involved_const if constituent_geometry[k]]
         }
     return relationships_with_props
 
 
-def visualize_relationships_by_type(relationships_to_viz, image_name, output_base_dir, image_dir):
+def load_image_bgr(image_path):
+    """
+    Decodes a diagram image into the opencv (BGR) buffer every output canvas of that image is drawn on.
+    """
+    return np.array(Image.open(image_path))[:, :, ::-1].copy()
+
+
+def draw_geometry(image, colored_geometry):
+    """
+    Draws constituent shapes in order. Each run of consecutive shapes in the same color takes one polylines call
+    for all of its polygons, which leaves the result identical to drawing the shapes one at a time.
+    :param colored_geometry: list of (ConstituentGeometry, color) tuples
+    """
+    for color, color_run in groupby(colored_geometry, key=lambda colored_shape: colored_shape[1]):
+        polygons = []
+        for geometry, _ in color_run:
+            if geometry.corners:
+                cv2.rectangle(image, geometry.corners[0], geometry.corners[1], color=color, thickness=2)
+            else:
+                polygons.append(geometry.points)
+        if polygons:
+            cv2.polylines(image, polygons, color=color, isClosed=True, thickness=2)
+
+
+def imwrite_params(render_settings):
+    if render_settings.image_format == 'jpeg':
+        return [cv2.IMWRITE_JPEG_QUALITY, render_settings.quality]
+    if render_settings.image_format == 'webp':
+        return [cv2.IMWRITE_WEBP_QUALITY, render_settings.quality]
+    if render_settings.png_compression is not None:
+        return [cv2.IMWRITE_PNG_COMPRESSION, render_settings.png_compression]
+    return []
+
+
+def write_image(image_path_stem, image, render_settings):
+    """
+    Encodes an image in the format chosen in the render settings.
+    :param image_path_stem: output path without the extension
+    :return: path of the written image
+    """
+    image_path = image_path_stem + image_extensions[render_settings.image_format]
+    cv2.imwrite(image_path, image, imwrite_params(render_settings))
+    return image_path
+
+
+def render_constituents(base_image, colored_geometry, use_canvas):
+    """
+    Draws constituents onto the shared base image, hands the canvas to use_canvas, and restores the region that was
+    drawn over, so one decoded image serves every canvas without a full copy per output.
+    :param base_image: BGR image buffer, left unchanged on return
+    :param colored_geometry: list of (ConstituentGeometry, color) tuples
+    :param use_canvas: function of the drawn canvas, e.g. one that writes it out
+    :return: use_canvas's return value
+    """
+    height, width = base_image.shape[:2]
+    line_margin = 2
+    if colored_geometry:
+        bounds = np.array([geometry.bounds for geometry, _ in colored_geometry])
+        x_min, y_min = np.maximum(bounds[:, :2].min(axis=0) - line_margin, 0)
+        x_max, y_max = np.minimum(bounds[:, 2:].max(axis=0) + line_margin + 1, (width, height))
+    else:
+        x_min = y_min = x_max = y_max = 0
+    saved_region = base_image[y_min:y_max, x_min:x_max].copy()
+    try:
+        draw_geometry(base_image, colored_geometry)
+        return use_canvas(base_image)
+    finally:
+        base_image[y_min:y_max, x_min:x_max] = saved_region
+
+
+def draw_and_write(base_image, colored_geometry, image_path_stem, render_settings=default_render_settings):
+    """
+    Draws constituents onto the shared base image and writes the result, see render_constituents.
+    :param image_path_stem: output path without the extension
+    :return: path of the written image
+    """
+    return render_constituents(base_image, colored_geometry,
+                               lambda canvas: write_image(image_path_stem, canvas, render_settings))
+
+
+def make_contact_sheet(tiles, tile_labels, tile_width):
+    """
+    Lays equally sized tiles out in a square-ish grid, each labeled in its top left corner.
+    """
+    n_columns = int(np.ceil(np.sqrt(len(tiles))))
+    n_rows = int(np.ceil(len(tiles) / float(n_columns)))
+    tile_height = tiles[0].shape[0]
+    contact_sheet = np.full((n_rows * tile_height, n_columns * tile_width, 3), 255, dtype=np.uint8)
+    for tile_n, (tile, tile_label) in enumerate(zip(tiles, tile_labels)):
+        y = (tile_n // n_columns) * tile_height
+        x = (tile_n % n_columns) * tile_width
+        contact_sheet[y:y + tile_height, x:x + tile_width] = tile
+        cv2.putText(contact_sheet, tile_label, (x + 4, y + 14), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 0), 1)
+    return contact_sheet
+
+
+def make_image_result_dir(output_base_dir, image_name):
     image_result_dir = output_base_dir + image_name.split('.')[0] + '/'
     try:
         os.mkdir(image_result_dir)
     except OSError as e:
         pass
+    return image_result_dir
 
-    pil_image = Image.open(image_dir + image_name)
+
+def visualize_relationships_by_type(relationships_to_viz, image_name, output_base_dir, image_dir, base_image=None,
+                                    render_settings=default_render_settings):
+    """
+    Writes one image per relationship category with every relationship of that category drawn in its own color.
+    :param base_image: decoded BGR image from load_image_bgr, loaded from image_dir when not given
+    :param render_settings: RenderSettings for the output format
+    :return: paths of the written images
+    """
+    image_result_dir = make_image_result_dir(output_base_dir, image_name)
+    if base_image is None:
+        base_image = load_image_bgr(image_dir + image_name)
 
     relations_by_cat = defaultdict(list)
     for rel_id, relationship in relationships_to_viz.items():
         relations_by_cat[relationship['category']].append(relationship)
 
+    written_paths = []
     for relationship_cat, relationships in relations_by_cat.items():
-        open_cv_image = np.array(pil_image)
-        open_cv_image = open_cv_image[:, :, ::-1].copy()
         if relationship_cat == 'arrowHeadTail':
             continue
+        colored_geometry = []
         for relationship in relationships:
             color_this_rel = random_color()
-            for c_id, constituent in relationship['constituents'].items():
-                if constituent['type'] in rect_types:
-                    ul, lr = constituent['rectangle']
-                    cv2.rectangle(open_cv_image, tuple(ul), tuple(lr), color=color_this_rel, thickness=2)
-                if constituent['type'] in poly_types:
-                    draw_polygon_on_image(open_cv_image, constituent['polygon'], color=color_this_rel)
-        image_path = image_result_dir + 'all_' + relationship_cat + 's_' + '.png'
-        cv2.imwrite(image_path, open_cv_image)
+            colored_geometry.extend((geometry, color_this_rel) for _, geometry in relationship['geometry'])
+        image_path_stem = image_result_dir + 'all_' + relationship_cat + 's_'
+        written_paths.append(draw_and_write(base_image, colored_geometry, image_path_stem, render_settings))
+    return written_paths
 
 
-def visualize_relationships(relationships_to_viz, image_name, output_base_dir, image_dir):
-    image_result_dir = output_base_dir + image_name.split('.')[0] + '/'
-    try:
-        os.mkdir(image_result_dir)
-    except OSError as e:
-        pass
-    
-    pil_image = Image.open(image_dir + image_name)
+def visualize_relationships(relationships_to_viz, image_name, output_base_dir, image_dir, base_image=None,
+                            render_settings=default_render_settings):
+    """
+    Writes one image per relationship, or a single contact sheet of all of them when render_settings asks for one.
+    :param base_image: decoded BGR image from load_image_bgr, loaded from image_dir when not given
+    :param render_settings: RenderSettings for the output format and layout
+    :return: paths of the written images
+    """
+    image_result_dir = make_image_result_dir(output_base_dir, image_name)
+    if base_image is None:
+        base_image = load_image_bgr(image_dir + image_name)
+
+    if render_settings.contact_sheet:
+        image_height, image_width = base_image.shape[:2]
+        tile_size = (render_settings.tile_width,
+                     max(1, int(round(image_height * render_settings.tile_width / float(image_width)))))
+
+        def make_tile(canvas):
+            return cv2.resize(canvas, tile_size, interpolation=cv2.INTER_AREA)
+
+    written_paths = []
+    tiles = []
+    tile_labels = []
     for rel_id, relationship in relationships_to_viz.items():
-        open_cv_image = np.array(pil_image) 
-        open_cv_image = open_cv_image[:, :, ::-1].copy() 
         rel_category = relationship['category']
         if rel_category == 'arrowHeadTail':
             continue
@@ -135,31 +291,189 @@ def visualize_relationships(relationships_to_viz, image_name, output_base_dir, i
             color_lookup = {}
             for idx, const in enumerate(ordered_const):
                 color_lookup[const] = color_defs[idx]
-            for c_id, constituent in relationship['constituents'].items():
-
-                if constituent['type'] in rect_types:
-                    ul, lr = constituent['rectangle']
-                    cv2.rectangle(open_cv_image, tuple(ul), tuple(lr), color=color_lookup[c_id], thickness=2)
-                if constituent['type'] in poly_types:
-                    draw_polygon_on_image(open_cv_image, constituent['polygon'], color=color_lookup[c_id])
+            colored_geometry = [(geometry, color_lookup[c_id]) for c_id, geometry in relationship['geometry']]
         else:
-            for c_id, constituent in relationship['constituents'].items():
-                if constituent['type'] in rect_types:
-                    ul, lr = constituent['rectangle']
-                    cv2.rectangle(open_cv_image, tuple(ul), tuple(lr), color=get_category_color(rel_category), thickness=2)
-                if constituent['type'] in poly_types:
-                    draw_polygon_on_image(open_cv_image, constituent['polygon'], color=get_category_color(rel_category))
-        image_path = image_result_dir + rel_category + '_' + rel_id.replace('+', '_') + '.png'
-        cv2.imwrite(image_path, open_cv_image)
-    
+            category_color = get_category_color(rel_category)
+            colored_geometry = [(geometry, category_color) for _, geometry in relationship['geometry']]
+        image_path_stem = image_result_dir + rel_category + '_' + rel_id.replace('+', '_')
+        if render_settings.contact_sheet:
+            tiles.append(render_constituents(base_image, colored_geometry, make_tile))
+            tile_labels.append(rel_category + ' ' + rel_id)
+        else:
+            written_paths.append(draw_and_write(base_image, colored_geometry, image_path_stem, render_settings))
+    if tiles:
+        contact_sheet = make_contact_sheet(tiles, tile_labels, render_settings.tile_width)
+        written_paths.append(write_image(image_result_dir + 'relationships_sheet', contact_sheet, render_settings))
+    return written_paths
+
+
+# bump when a change to the drawing code should invalidate every incrementally rendered output
+renderer_version = 1
+
+
+def render_settings_version(render_settings):
+    settings_json = json.dumps([renderer_version] + list(render_settings))
+    return hashlib.sha1(settings_json).hexdigest()
+
+
+def file_fingerprint(file_path, previous_fingerprint=None):
+    """
+    Identifies the content of an input file. The content hash is only recomputed when the mtime or size differ from
+    the previous fingerprint.
+    :return: dict of mtime, size and sha1
+    """
+    stats = os.stat(file_path)
+    if previous_fingerprint and previous_fingerprint['mtime'] == stats.st_mtime and \
+            previous_fingerprint['size'] == stats.st_size:
+        return previous_fingerprint
+    with open(file_path, 'rb') as f:
+        content_hash = hashlib.sha1(f.read()).hexdigest()
+    return {'mtime': stats.st_mtime, 'size': stats.st_size, 'sha1': content_hash}
+
 
-def visualize_image_batch(image_dir, annotation_dir, output_dir):
-    for image in glob.glob(annotation_dir + '*'):
-        image_name = image.split('.json')[0].split('/')[-1]
+def load_render_manifest(manifest_path, settings_version):
+    """
+    :return: image_name:entry dict of earlier renders, with the input fingerprints and output paths of each image.
+    Entries are kept when the settings changed, so their outputs can still be cleaned up, but marked as stale.
+    """
+    try:
+        with open(manifest_path, 'r') as f:
+            render_manifest = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if render_manifest.get('settings_version') != settings_version:
+        for entry in render_manifest['images'].values():
+            entry['stale'] = True
+    return render_manifest['images']
+
+
+def save_render_manifest(manifest_path, settings_version, manifest_entries):
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        json.dump({'settings_version': settings_version, 'images': manifest_entries}, f)
+    os.rename(temp_path, manifest_path)
+
+
+def remove_outputs(output_paths):
+    for output_path in output_paths:
+        try:
+            os.remove(output_path)
+        except OSError:
+            pass
+
+
+def visualize_image(image_job):
+    """
+    Process pool task for visualize_image_batch: renders both passes for one annotated image. Errors are caught so
+    one bad annotation doesn't stop the batch.
+    :param image_job: (image_dir, annotation_dir, output_dir, annotation path, render settings) tuple
+    :return: image name, written paths, number of relationships rendered and None, or image name, an empty list, 0
+    and the error message
+    """
+    image_dir, annotation_dir, output_dir, annotation_path, render_settings = image_job
+    image_name = annotation_path.split('.json')[0].split('/')[-1]
+    try:
         image_annotations = load_local_annotation(image_name, annotation_dir)
         to_visualize = build_relationships_to_draw(image_annotations)
-        visualize_relationships_by_type(to_visualize, image_name, output_dir, image_dir)
-        visualize_relationships(to_visualize, image_name, output_dir, image_dir)
+        base_image = load_image_bgr(image_dir + image_name)
+        written_paths = visualize_relationships_by_type(to_visualize, image_name, output_dir, image_dir, base_image,
+                                                        render_settings)
+        written_paths += visualize_relationships(to_visualize, image_name, output_dir, image_dir, base_image,
+                                                 render_settings)
+        n_relationships = sum(1 for relationship in to_visualize.values()
+                              if relationship['category'] != 'arrowHeadTail')
+        return image_name, written_paths, n_relationships, None
+    except Exception as e:
+        return image_name, [], 0, repr(e)
+
+
+@instrumented('visualize_image_batch')
+def visualize_image_batch(image_dir, annotation_dir, output_dir, jobs=1, render_settings=default_render_settings,
+                          incremental=False):
+    """
+    Renders every annotated image in annotation_dir.
+    :param jobs: size of the process pool images are spread across
+    :param render_settings: RenderSettings for the output format and layout
+    :param incremental: only render images whose image or annotation changed since the last incremental run, or
+    all of them when the render settings changed. Runs are tracked in render_manifest.json in output_dir, and
+    outputs that earlier runs wrote but a re-render doesn't (e.g. of deleted relationships or annotations) are
+    removed. An image that fails to render keeps its earlier outputs and is retried on the next run.
+    :return: summary dict with the number of images and relationships rendered, the number of unchanged images
+    skipped and an image_name:error dict of the images that failed
+    """
+    annotation_paths = glob.glob(annotation_dir + '*')
+    summary = {'images': 0, 'relationships': 0, 'skipped': 0, 'failed': {}}
+    manifest_entries = {}
+    input_fingerprints = {}
+    if incremental:
+        manifest_path = output_dir + 'render_manifest.json'
+        settings_version = render_settings_version(render_settings)
+        manifest_entries = load_render_manifest(manifest_path, settings_version)
+        changed_paths = []
+        for annotation_path in annotation_paths:
+            image_name = annotation_path.split('.json')[0].split('/')[-1]
+            entry = manifest_entries.get(image_name, {})
+            try:
+                input_fingerprints[image_name] = {
+                    'image': file_fingerprint(image_dir + image_name, entry.get('image')),
+                    'annotation': file_fingerprint(annotation_path, entry.get('annotation'))
+                }
+            except (IOError, OSError):
+                input_fingerprints[image_name] = {}
+            if entry and not entry.get('stale') and input_fingerprints[image_name] and \
+                    input_fingerprints[image_name]['image']['sha1'] == entry['image']['sha1'] and \
+                    input_fingerprints[image_name]['annotation']['sha1'] == entry['annotation']['sha1']:
+                entry.update(input_fingerprints[image_name])
+                summary['skipped'] += 1
+            else:
+                changed_paths.append(annotation_path)
+        annotated_images = set(input_fingerprints)
+        for image_name in [image_name for image_name in manifest_entries if image_name not in annotated_images]:
+            remove_outputs(manifest_entries.pop(image_name)['outputs'])
+            try:
+                os.rmdir(output_dir + image_name.split('.')[0] + '/')
+            except OSError:
+                pass
+        annotation_paths = changed_paths
+    image_jobs = [(image_dir, annotation_dir, output_dir, annotation_path, render_settings)
+                  for annotation_path in annotation_paths]
+
+    def add_to_summary(image_results):
+        for image_name, written_paths, n_relationships, error in image_results:
+            if error:
+                # keep the outputs of the last good render; the stale entry is retried on the next run
+                if image_name in manifest_entries:
+                    manifest_entries[image_name]['stale'] = True
+                summary['failed'][image_name] = error
+                continue
+            if incremental:
+                previous_outputs = manifest_entries.pop(image_name, {}).get('outputs', [])
+                remove_outputs(set(previous_outputs) - set(written_paths))
+                if input_fingerprints[image_name]:
+                    manifest_entries[image_name] = dict(input_fingerprints[image_name], outputs=written_paths)
+            summary['images'] += 1
+            summary['relationships'] += n_relationships
+            if instrumentation.metrics_enabled:
+                instrumentation.record_bytes('visualize_image_batch',
+                                             instrumentation.file_size(annotation_dir + image_name + '.json') +
+                                             instrumentation.file_size(image_dir + image_name),
+                                             sum(instrumentation.file_size(image_path)
+                                                 for image_path in written_paths))
+
+    try:
+        if jobs == 1:
+            add_to_summary(imap(visualize_image, image_jobs))
+        else:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                add_to_summary(pool.imap_unordered(visualize_image, image_jobs))
+            finally:
+                pool.terminate()
+    finally:
+        if incremental:
+            save_render_manifest(manifest_path, settings_version, manifest_entries)
+    instrumentation.record_report_errors('visualize_image_batch', summary['failed'])
+    return summary
 
 
 def main():
@@ -167,10 +481,27 @@ def main():
     parser.add_argument('imgdir', help='path to shining diagram images', type=str)
     parser.add_argument('anndir', help='path to annotations', type=str)
     parser.add_argument('outdir', help='directory to write output images', type=str)
+    parser.add_argument('--jobs', help='number of images rendered in parallel', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--format', help='output image format', choices=sorted(image_extensions), default='png')
+    parser.add_argument('--quality', help='jpeg / webp quality', type=int, default=90)
+    parser.add_argument('--png-compression', help='png compression level, 0-9', type=int, default=None)
+    parser.add_argument('--contact-sheet', help='tile all relationships of an image into one image',
+                        action='store_true')
+    parser.add_argument('--tile-width', help='contact sheet tile width in pixels', type=int, default=320)
+    parser.add_argument('--incremental', help='only re-render images whose image or annotation changed',
+                        action='store_true')
     args = parser.parse_args()
     paths = [args.imgdir, args.anndir, args.outdir]
     paths = map(lambda x: x + '/', paths)
-    visualize_image_batch(*paths)
+    render_settings = RenderSettings(args.format, args.quality, args.png_compression, args.contact_sheet,
+                                     args.tile_width)
+    summary = visualize_image_batch(*paths, jobs=args.jobs, render_settings=render_settings,
+                                    incremental=args.incremental)
+    for image_name, error in sorted(summary['failed'].items()):
+        print('failed to render %s: %s' % (image_name, error))
+    print('rendered %d relationships from %d images, %d unchanged images skipped, %d images failed' %
+          (summary['relationships'], summary['images'], summary['skipped'], len(summary['failed'])))
 
 if __name__ == "__main__":
     main()